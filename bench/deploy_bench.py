@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+'''
+Offline benchmark for the deploy.rails state
+
+Runs states/_states/deploy.py and states/_modules/deploy_template.py against
+a generated local git repository with a fake __salt__ that maps the salt
+calls they make to local commands and filesystem operations, the templates
+served from a local file_roots with a configurable latency per request to
+the master, and stub bundle/rake executables that sleep for a configurable
+time. Reports the time of a cold deploy, a deploy with nothing
+changed and a deploy of a new sha. With --artifact it also builds the sha
+once into a local directory artifact store and deploys it from there.
+
+  python bench/deploy_bench.py --files 2000 --refs 500 --submodules 2 --latency 0.5 --templates 15
+'''
+# Import python libs
+import os
+import sys
+import imp
+import json
+import re
+import time
+import types
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+from pwd import getpwuid
+from grp import getgrgid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEPLOY = os.path.join(ROOT, 'states', '_states', 'deploy.py')
+DEPLOY_TEMPLATE = os.path.join(ROOT, 'states', '_modules', 'deploy_template.py')
+
+# bundle and rake stand-ins. BENCH_LATENCY is the time every bundle install
+# and every rake invocation takes
+BUNDLE_STUB = r'''#!/bin/bash
+case "$1" in
+  --version)
+    echo "Bundler version 1.3.5"
+    ;;
+  install)
+    sleep "$BENCH_LATENCY"
+    for arg in "$@"; do
+      case "$arg" in --path=*) mkdir -p "${arg#--path=}/ruby/1.9.1" ;; esac
+    done
+    mkdir -p .bundle && echo "BUNDLE_FROZEN: '1'" > .bundle/config
+    ;;
+  exec)
+    shift
+    exec "$@"
+    ;;
+esac
+'''
+
+RAKE_STUB = r'''#!/bin/bash
+sleep "$BENCH_LATENCY"
+if [ "$1" = "-P" ]; then
+  echo "rake db:migrate"
+  echo "    environment"
+  echo "rake assets:precompile"
+  exit 0
+fi
+for task in "$@"; do
+  case "$task" in
+    assets:precompile) mkdir -p public/assets && echo '{}' > public/assets/manifest.yml ;;
+  esac
+done
+'''
+
+RVM_STUB = r'''
+rvm() { :; }
+export PATH="$BENCH_BIN:$PATH"
+'''
+
+def sh(cmd, cwd=None, env=None):
+  """Run a shell command, failing loudly"""
+  proc = subprocess.Popen(cmd, shell=True, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  out, err = proc.communicate()
+  if proc.returncode != 0:
+    raise RuntimeError("%s failed: %s" % (cmd, err))
+  return out
+
+def write(path, content, mode=None):
+  """Write a file, creating its directory"""
+  if not os.path.isdir(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  with open(path, 'w') as f:
+    f.write(content)
+  if mode:
+    os.chmod(path, mode)
+
+def make_repo(path, files, refs, commit_files=None):
+  """A rails-like git repository with files files and refs branches and tags"""
+  sh('git init -q %s' % path)
+  sh('git config user.email bench@localhost && git config user.name bench', cwd=path)
+  write(os.path.join(path, 'Gemfile'), "source 'https://rubygems.org'\ngem 'rails'\n")
+  write(os.path.join(path, 'Gemfile.lock'), "GEM\n  specs:\n    rails (3.2.13)\n")
+  write(os.path.join(path, 'config', 'application.rb'), "# application\n")
+  for i in range(5):
+    write(os.path.join(path, 'db', 'migrate', '2013010100000%d_migration_%d.rb' % (i, i)), "# %d\n" % i)
+  for i in range(files):
+    group = ['app/models', 'app/assets/javascripts', 'lib', 'vendor/assets/stylesheets'][i % 4]
+    write(os.path.join(path, group, 'file_%05d.rb' % i), ("# file %d\n" % i) * 20)
+  sh('git add -A && git commit -q -m initial', cwd=path)
+  # Plain ref creation, the content does not matter for ls-remote
+  for i in range(refs):
+    kind = 'heads' if i % 2 else 'tags'
+    sh('git update-ref refs/%s/ref-%05d HEAD' % (kind, i), cwd=path)
+
+def add_submodules(path, count, workdir, files):
+  """Add count submodules to the repository at path"""
+  for i in range(count):
+    sub = os.path.join(workdir, 'submodule-%d' % i)
+    make_repo(sub, files, 0)
+    sh('git -c protocol.file.allow=always submodule add -q %s vendor/sub%d' % (sub, i), cwd=path)
+  if count:
+    sh('git commit -q -m submodules', cwd=path)
+
+def new_commit(path):
+  """Commit a change that touches code but not the gems, assets or migrations"""
+  write(os.path.join(path, 'app', 'models', 'bench_%s.rb' % time.time()), "# changed\n")
+  sh('git add -A && git commit -q -m change', cwd=path)
+
+def write_templates(file_roots, count):
+  """The templates of the master, with count config templates, returning the config_templates option"""
+  write(os.path.join(file_roots, 'states_templates', 'database.yml'),
+    "{{ rails_env }}:\n  adapter: {{ adapter }}\n  database: {{ database }}\n")
+  config_templates = {}
+  for i in range(count):
+    name = 'bench_%02d.yml' % i
+    write(os.path.join(file_roots, 'states_templates', 'config', name), "# %d\nname: {{ name }}\n" % i)
+    config_templates[name] = 'salt://states_templates/config/%s' % name
+  return config_templates
+
+def fake_salt(user, group, workdir, master_latency):
+  """
+  The salt functions deploy.rails and deploy_template call, done locally.
+  Every request to the master takes master_latency seconds
+  """
+  file_roots = os.path.join(workdir, 'file_roots')
+  minion_cache = os.path.join(workdir, 'minion_cache')
+
+  def makedirs_perms(path, user=None, group=None, mode=None):
+    if not os.path.isdir(path):
+      os.makedirs(path)
+
+  def source_list(source, source_hash, env):
+    # Like salt, only a list of alternatives is looked up on the master
+    if isinstance(source, list):
+      time.sleep(master_latency)
+      source = source[0]
+    return source, source_hash
+
+  def cache_files(paths, env='base'):
+    time.sleep(master_latency)
+    cached = []
+    for path in paths:
+      relpath = path[len('salt://'):]
+      if not os.path.isfile(os.path.join(file_roots, relpath)):
+        cached.append('')
+        continue
+      dest = os.path.join(minion_cache, env, relpath)
+      write(dest, open(os.path.join(file_roots, relpath)).read())
+      cached.append(dest)
+    return cached
+
+  def manage_file(name, sfn, ret, source, source_sum, user, group, mode, env, backup):
+    if not os.path.isdir(os.path.dirname(name)):
+      os.makedirs(os.path.dirname(name))
+    shutil.copyfile(sfn, name)
+    os.chmod(name, int(str(mode), 8))
+    ret.update({'result': True, 'comment': 'File %s updated' % name, 'changes': {'diff': 'updated'}})
+    return ret
+
+  return {
+    'cp.cache_file': lambda path, env='base': '',
+    'cp.cache_files': cache_files,
+    'file.source_list': source_list,
+    'file.manage_file': manage_file,
+    'file.makedirs_perms': makedirs_perms,
+    'file.chown': lambda *args, **kwargs: True,
+    'grains.item': lambda *items: dict((i, 1) for i in items),
+    'rvm.is_installed': lambda *args, **kwargs: True,
+    'rvm.list': lambda *args, **kwargs: [['ruby', '1.9.3-p194', 'default']],
+    'rvm.gemset_list': lambda *args, **kwargs: ['global'],
+    'rvm.do': lambda *args, **kwargs: '',
+  }
+
+def render_template(path, to_str=True, **context):
+  """{{ name }} substitution standing in for the jinja renderer of salt"""
+  with open(path) as f:
+    text = f.read()
+  return {'result': True, 'data': re.sub(r'{{\s*(\w+)\s*}}', lambda m: str(context.get(m.group(1), '')), text)}
+
+def load_deploy(salt_funcs, grains, cachedir):
+  """
+  Load the deploy state and the deploy_template module the way the salt
+  loader would, sharing one __context__
+  """
+  try:
+    import salt.utils
+    import salt.utils.templates
+    import salt.exceptions
+  except ImportError:
+    # Only what deploy.py and deploy_template.py import, for boxes without salt
+    salt = types.ModuleType('salt')
+    salt.utils = types.ModuleType('salt.utils')
+    salt.utils.mkstemp = lambda: tempfile.mkstemp()[1]
+    salt.utils.templates = types.ModuleType('salt.utils.templates')
+    salt.utils.templates.TEMPLATE_REGISTRY = {'jinja': render_template}
+    salt.exceptions = types.ModuleType('salt.exceptions')
+    salt.exceptions.SaltException = type('SaltException', (Exception,), {})
+    sys.modules.update({'salt': salt, 'salt.utils': salt.utils, 'salt.utils.templates': salt.utils.templates,
+                        'salt.exceptions': salt.exceptions})
+
+  opts = {'cachedir': cachedir, 'test': False}
+  context = {}
+  templates = imp.load_source('deploy_bench_template', DEPLOY_TEMPLATE)
+  deploy = imp.load_source('deploy_bench_state', DEPLOY)
+  for module in [templates, deploy]:
+    module.__salt__ = salt_funcs
+    module.__grains__ = grains
+    module.__opts__ = opts
+    module.__pillar__ = {}
+    module.__context__ = context
+  for name in ['prefetch', 'manage', 'manage_many', 'render']:
+    salt_funcs['deploy_template.' + name] = getattr(templates, name)
+  return deploy
+
+def run_deploy(deploy, repo, docroot, user, group, concurrency, revision='master', artifact={}, config_templates={}):
+  """Run deploy.rails once, returning the wall time and the timeline"""
+  # Every deploy is a state run of its own, with nothing fetched yet
+  deploy.__context__.clear()
+  start = time.time()
+  ret = deploy.rails('bench', repo, docroot,
+    user=user,
+    group=group,
+    revision=revision,
+    revision_ttl=0,
+    concurrency=concurrency,
+    artifact=artifact,
+    config_templates=config_templates,
+    __env__='base')
+  duration = time.time() - start
+  if not ret['result']:
+    raise RuntimeError("Deploy failed: %s" % ret['comment'])
+  return duration, ret['changes'].get('timeline', [])
+
+def summarize(name, duration, timeline):
+  """One report line per scenario, with the slowest phases"""
+  phases = sorted(timeline, key=lambda e: e['duration'], reverse=True)[:4]
+  slow = ', '.join('%s %.2fs%s' % (e['phase'], e['duration'], ' (skipped)' if e.get('skipped') else ' (cached)' if e.get('cached') else '') for e in phases)
+  return {'scenario': name, 'seconds': round(duration, 3), 'slowest': slow}
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--files', type=int, default=500, help='files in the generated repository')
+  parser.add_argument('--refs', type=int, default=200, help='branches and tags in the generated repository')
+  parser.add_argument('--submodules', type=int, default=0, help='submodules in the generated repository')
+  parser.add_argument('--latency', type=float, default=0.2, help='seconds every bundle install and rake run takes')
+  parser.add_argument('--templates', type=int, default=10, help='config templates rendered from the master')
+  parser.add_argument('--master-latency', type=float, default=0.01, help='seconds every request to the master takes')
+  parser.add_argument('--concurrency', type=int, default=4, help='deploy phases run at the same time')
+  parser.add_argument('--artifact', action='store_true', help='also build once and deploy from an artifact store')
+  parser.add_argument('--json', action='store_true', help='print the results as json')
+  parser.add_argument('--keep', action='store_true', help='keep the work directory')
+  parser.add_argument('--verbose', action='store_true', help='log what the deploy state does')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+  workdir = tempfile.mkdtemp(prefix='deploy-bench-')
+  try:
+    user = getpwuid(os.getuid()).pw_name
+    group = getgrgid(os.getgid()).gr_name
+    bindir = os.path.join(workdir, 'bin')
+    write(os.path.join(bindir, 'bundle'), BUNDLE_STUB, 0755)
+    write(os.path.join(bindir, 'rake'), RAKE_STUB, 0755)
+    rvm_script = os.path.join(workdir, 'rvm', 'scripts', 'rvm')
+    write(rvm_script, RVM_STUB)
+    for d in ['rubies', 'gems']:
+      os.makedirs(os.path.join(workdir, 'rvm', d))
+    os.environ.update({'BENCH_BIN': bindir, 'BENCH_LATENCY': str(args.latency)})
+
+    repo = os.path.join(workdir, 'repo')
+    make_repo(repo, args.files, args.refs)
+    add_submodules(repo, args.submodules, workdir, max(args.files / 10, 1))
+
+    cachedir = os.path.join(workdir, 'cache')
+    os.makedirs(cachedir)
+    config_templates = write_templates(os.path.join(workdir, 'file_roots'), args.templates)
+    deploy = load_deploy(fake_salt(user, group, workdir, args.master_latency), {'num_cpus': 2, 'environment': 'bench'}, cachedir)
+    deploy.RVM_PATH = os.path.join(workdir, 'rvm')
+    deploy.RVM_SCRIPT = rvm_script
+
+    docroot = os.path.join(workdir, 'app')
+    results = []
+    results.append(summarize('cold deploy', *run_deploy(deploy, repo, docroot, user, group, args.concurrency, config_templates=config_templates)))
+    results.append(summarize('warm no-change deploy', *run_deploy(deploy, repo, docroot, user, group, args.concurrency, config_templates=config_templates)))
+    new_commit(repo)
+    results.append(summarize('new sha deploy', *run_deploy(deploy, repo, docroot, user, group, args.concurrency, config_templates=config_templates)))
+
+    if args.artifact:
+      store = os.path.join(workdir, 'artifacts')
+      build = {'mode': 'build', 'store': store}
+      fetch = {'mode': 'fetch', 'store': 'file://' + store}
+      results.append(summarize('artifact build', *run_deploy(deploy, repo, os.path.join(workdir, 'builder'), user, group, args.concurrency, artifact=build, config_templates=config_templates)))
+      results.append(summarize('artifact fetch deploy', *run_deploy(deploy, repo, os.path.join(workdir, 'node'), user, group, args.concurrency, artifact=fetch, config_templates=config_templates)))
+
+    if args.json:
+      print json.dumps({'options': vars(args), 'results': results}, indent=2)
+    else:
+      print "files=%s refs=%s submodules=%s latency=%ss" % (args.files, args.refs, args.submodules, args.latency)
+      for r in results:
+        print "%-24s %8.3fs   %s" % (r['scenario'], r['seconds'], r['slowest'])
+  finally:
+    if args.keep:
+      print "work directory: %s" % workdir
+    else:
+      shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,97 @@
+"""
+The GIT_SSH wrappers of the deploy and private_git states.
+
+Every git command of a deploy used to open an ssh connection of its own.
+salt://states_templates/git_deploy_wrapper is still rendered with id_deploy
+and port, next to the wrapper, and the wrapper git runs passes it the options
+that make ssh share one connection per deploy key through a ControlMaster
+socket next to the key. The connection is kept open for persist seconds after
+the last command and closed by close at the end of the state.
+"""
+import os
+import glob
+import logging
+import subprocess
+
+log = logging.getLogger(__name__)
+
+SOURCE = 'salt://states_templates/git_deploy_wrapper'
+
+WRAPPER = '''#!/bin/sh
+# Managed by salt. Shares the connection to the git host per deploy key
+exec {ssh} -o ControlMaster=auto -o ControlPath={control_dir}/%r@%h:%p -o ControlPersist={persist} "$@"
+'''
+
+def wrapper(path, id_deploy, port=22, user='root', group='root', env='base', persist=60):
+  """
+  Render the git_deploy_wrapper template for the key id_deploy next to path,
+  and write the GIT_SSH wrapper at path that runs it with a shared connection
+  """
+  ret = {'name': path, 'result': True, 'comment': '', 'changes': {}}
+  control_dir = _control_dir(id_deploy)
+  if not os.path.isdir(control_dir):
+    os.mkdir(control_dir, 0700)
+    __salt__['file.chown'](control_dir, user, group)
+
+  ssh = _ssh_path(path)
+  rendered = __salt__['deploy_template.manage'](ssh, SOURCE, 755,
+    user=user,
+    group=group,
+    env=env,
+    defaults=template_defaults(id_deploy, port))
+  if rendered['result'] is False:
+    return rendered
+  if rendered['changes']:
+    ret['changes']['ssh'] = rendered['changes']
+
+  content = WRAPPER.format(ssh=ssh, control_dir=control_dir, persist=int(persist))
+  current = None
+  if os.path.isfile(path):
+    with open(path) as f:
+      current = f.read()
+  if current == content:
+    ret['comment'] = 'Wrapper {0} is in the correct state'.format(path)
+    return ret
+
+  tmp = '{0}.tmp-{1}'.format(path, os.getpid())
+  with open(tmp, 'w') as f:
+    f.write(content)
+  os.chmod(tmp, 0755)
+  __salt__['file.chown'](tmp, user, group)
+  os.rename(tmp, path)
+  ret['changes']['diff'] = 'updated' if current is not None else 'new'
+  ret['comment'] = 'Wrapper {0} updated'.format(path)
+  return ret
+
+def template_defaults(id_deploy, port=22):
+  """The variables the wrapper template is rendered with"""
+  return {'id_deploy': id_deploy, 'port': port}
+
+def close(id_deploy):
+  """Close the shared connections of the key id_deploy, returning how many were open"""
+  closed = 0
+  devnull = open(os.devnull, 'w')
+  try:
+    for socket in glob.glob(os.path.join(_control_dir(id_deploy), '*')):
+      # Any host will do, the control path alone names the connection
+      retcode = subprocess.call(['ssh', '-o', 'ControlPath={0}'.format(socket), '-O', 'exit', 'git-host'],
+        stdout=devnull, stderr=devnull)
+      if retcode == 0:
+        closed += 1
+      else:
+        log.debug("No master listening on {0}, removing it".format(socket))
+        try:
+          os.remove(socket)
+        except OSError:
+          pass
+  finally:
+    devnull.close()
+  return closed
+
+def _ssh_path(path):
+  """The rendered git_deploy_wrapper template behind the wrapper at path"""
+  return os.path.join(os.path.dirname(path), '.' + os.path.basename(path))
+
+def _control_dir(id_deploy):
+  """The directory of the control sockets of a key, next to the key"""
+  return os.path.join(os.path.dirname(os.path.abspath(id_deploy)), '.ssh-control')
@@ -0,0 +1,157 @@
+"""
+Render and manage templated files for the deploy and private_git states.
+
+Sources are resolved and fetched from the master once per run and kept by
+hash, and files whose rendered content, mode and owner already match what is
+on disk are left alone without going through file.manage_file.
+"""
+import os
+import hashlib
+import logging
+from pwd import getpwnam
+from grp import getgrnam
+
+# Import salt libs
+import salt.utils
+import salt.utils.templates
+from salt.exceptions import SaltException
+
+log = logging.getLogger(__name__)
+
+def prefetch(sources, env='base'):
+  """
+  Resolve and fetch a batch of salt:// sources, so later calls to manage and
+  manage_many render from the local copies
+  """
+  cache = _source_cache()
+  _fetch_all(sources, env, cache)
+  return dict((s, cache[(s, env)]['hsum']) for s in sources if (s, env) in cache)
+
+def manage(path, source, mode, user='root', group='root', env='base', defaults=None, template='jinja'):
+  """
+  Render source with defaults and manage path with it
+  """
+  source_info = _fetch(source, env, _source_cache())
+  return _manage(path, source_info, mode, user, group, env, defaults or {}, template)
+
+def manage_many(files, env='base'):
+  """
+  Manage a batch of files. files is a list of dicts with the keys path,
+  source, mode and optionally user, group, defaults and template. Every
+  source is fetched before anything is rendered. Returns the manage_file
+  style result of every path
+  """
+  cache = _source_cache()
+  _fetch_all([f['source'] for f in files], env, cache)
+
+  ret = {}
+  for f in files:
+    ret[f['path']] = _manage(f['path'],
+      cache[(f['source'], env)],
+      f['mode'],
+      f.get('user', 'root'),
+      f.get('group', 'root'),
+      env,
+      f.get('defaults', {}),
+      f.get('template', 'jinja'))
+  return ret
+
+def render(source, env='base', defaults=None, template='jinja'):
+  """
+  Return the md5 of source rendered with defaults, without touching any file
+  """
+  source_info = _fetch(source, env, _source_cache())
+  return hashlib.md5(_render(source_info, env, defaults or {}, template)).hexdigest()
+
+def _source_cache():
+  """The per run cache of fetched sources, or one for this call without a __context__"""
+  context = globals().get('__context__')
+  if context is None:
+    return {}
+  return context.setdefault('deploy_template.sources', {})
+
+def _fetch(source, env, cache):
+  """Resolve and cache source, once per run"""
+  _fetch_all([source], env, cache)
+  return cache[(source, env)]
+
+def _fetch_all(sources, env, cache):
+  """Resolve the sources not cached yet and fetch them in a single request"""
+  missing = []
+  for source in sources:
+    if (source, env) not in cache and source not in missing:
+      missing.append(source)
+  if not missing:
+    return
+
+  resolved = [__salt__['file.source_list'](source, '', env) for source in missing]
+  cached = __salt__['cp.cache_files']([r[0] for r in resolved], env)
+  for source, (source_path, source_hash), cached_path in zip(missing, resolved, cached):
+    if not cached_path:
+      raise SaltException("Could not fetch {0}".format(source))
+    with open(cached_path, 'rb') as f:
+      hsum = hashlib.md5(f.read()).hexdigest()
+    log.debug("Fetched {0} to {1} ({2})".format(source_path, cached_path, hsum))
+    cache[(source, env)] = {'source': source_path, 'source_hash': source_hash, 'cached': cached_path, 'hsum': hsum}
+
+def _render(source_info, env, defaults, template):
+  """Render the cached copy of a source"""
+  if not template:
+    with open(source_info['cached'], 'rb') as f:
+      return f.read()
+
+  context = dict(defaults)
+  context.update({
+    'salt': __salt__,
+    'grains': __grains__,
+    'opts': __opts__,
+    'pillar': __pillar__,
+    'env': env
+  })
+  data = salt.utils.templates.TEMPLATE_REGISTRY[template](source_info['cached'], to_str=True, **context)
+  if not data['result']:
+    raise SaltException("Failed to render {0}: {1}".format(source_info['source'], data['data']))
+  return data['data']
+
+def _is_current(path, hsum, mode, user, group):
+  """Check if path already has the content hsum, mode and owner"""
+  try:
+    st = os.stat(path)
+  except OSError:
+    return False
+  if '%o' % (st.st_mode & 0777) != str(mode).lstrip('0'):
+    return False
+  try:
+    if st.st_uid != getpwnam(user).pw_uid or st.st_gid != getgrnam(group).gr_gid:
+      return False
+  except KeyError:
+    return False
+  with open(path, 'rb') as f:
+    return hashlib.md5(f.read()).hexdigest() == hsum
+
+def _manage(path, source_info, mode, user, group, env, defaults, template):
+  """Render and write a single file, unless it is already current"""
+  ret = {'name': path, 'result': None, 'comment': '', 'changes': {}}
+  data = _render(source_info, env, defaults, template)
+  hsum = hashlib.md5(data).hexdigest()
+
+  if _is_current(path, hsum, mode, user, group):
+    log.debug("{0} is current, not managing it".format(path))
+    ret['result'] = True
+    ret['comment'] = 'File {0} is in the correct state'.format(path)
+    return ret
+
+  sfn = salt.utils.mkstemp()
+  with open(sfn, 'wb') as f:
+    f.write(data)
+  try:
+    source_sum = {'hash_type': 'md5', 'hsum': hsum}
+    ret = __salt__['file.manage_file'](path, sfn, ret, source_info['source'], source_sum, user, group, mode, env, '')
+    log.debug("ret for manage_file: {0}".format(ret))
+  except Exception, e:
+    log.error("Something went wrong :( {comment} / {exception}".format(comment=ret['comment'], exception=e))
+    raise e
+  finally:
+    if os.path.isfile(sfn):
+      os.remove(sfn)
+  return ret
@@ -0,0 +1,201 @@
+"""
+Roll a state out over the nodes of a role in batches.
+
+The nodes of every batch are deployed at the same time, and a batch only
+starts once the previous one deployed and passed its health check, so a
+rollout takes as long as its number of batches, not its number of nodes, and
+never takes more than one batch out of service. The first failure stops it.
+
+  salt-call fleet.rollout app state.sls arg='["app"]' batch=25% \\
+    health_check='{"url": "http://{ip}:8080/health"}'
+
+The nodes are reached through an executor: publish (the default, which needs
+the master to allow peer publishing of the function), local (a LocalClient,
+on the master), the name of any salt function or a callable taking
+(nodes, fun, arg, timeout) and returning the return of every node.
+"""
+import math
+import time
+import Queue
+import logging
+import threading
+import urllib2
+
+# Import salt libs
+from salt.exceptions import SaltException
+
+log = logging.getLogger(__name__)
+
+def rollout(role, fun='state.sls', arg=None, batch='25%', concurrency=None,
+            health_check=None, executor='publish', timeout=600):
+  """
+  Run fun with arg on the nodes of role, batch by batch
+
+  batch
+    The nodes per batch, a count or a percentage of the role
+
+  concurrency
+    The nodes of a batch running at the same time, all of them by default
+
+  health_check
+    Checked on every node of a batch before the next batch starts:
+      url: requested until it answers with status, {node} and {ip} are
+           replaced by the node and its address
+      fun, arg, expect: a function run on the nodes instead, that has to
+           return expect (True by default)
+      status (200), timeout (5), retries (10), interval (3)
+
+  Returns the result, the batches with the return of every node and the
+  nodes that were not deployed
+  """
+  ret = {'result': True, 'comment': '', 'batches': [], 'skipped': []}
+  nodes = sorted(__salt__['informer.get_roles'](role))
+  if not nodes:
+    ret['comment'] = 'No nodes with the role {0}'.format(role)
+    return ret
+
+  run = _executor(executor)
+  batches = _batches(nodes, batch)
+  start = time.time()
+  for i, batch_nodes in enumerate(batches):
+    batch_start = time.time()
+    log.info("Deploying batch {0}/{1}: {2}".format(i + 1, len(batches), batch_nodes))
+    results = _run_batch(run, batch_nodes, fun, arg, timeout, concurrency)
+    report = {
+      'nodes': batch_nodes,
+      'results': dict((node, {'result': _succeeded(results.get(node)), 'return': results.get(node)}) for node in batch_nodes),
+      'healthy': None
+    }
+    ret['batches'].append(report)
+
+    failed = [node for node in batch_nodes if not report['results'][node]['result']]
+    if not failed and health_check:
+      unhealthy = _unhealthy(run, batch_nodes, health_check, timeout)
+      report['healthy'] = not unhealthy
+      failed = unhealthy
+    report['duration'] = round(time.time() - batch_start, 3)
+
+    if failed:
+      ret['result'] = False
+      ret['skipped'] = [node for b in batches[i + 1:] for node in b]
+      ret['comment'] = 'Stopped after batch {0}/{1}, failed on {2}'.format(i + 1, len(batches), ', '.join(failed))
+      return ret
+
+  ret['comment'] = 'Deployed {0} nodes in {1} batches in {2:.1f}s'.format(len(nodes), len(batches), time.time() - start)
+  return ret
+
+def _batches(nodes, batch):
+  """Split nodes in batches of a count or a percentage of them"""
+  batch = str(batch).strip()
+  if batch.endswith('%'):
+    size = int(math.ceil(len(nodes) * float(batch[:-1]) / 100))
+  else:
+    size = int(batch)
+  size = max(size, 1)
+  return [nodes[i:i + size] for i in range(0, len(nodes), size)]
+
+def _executor(executor):
+  """The function running (nodes, fun, arg, timeout) on the nodes"""
+  if callable(executor):
+    return executor
+  if executor == 'publish':
+    return _publish
+  if executor == 'local':
+    return _local_client
+  if executor in __salt__:
+    return __salt__[executor]
+  raise SaltException("Unknown executor {0}".format(executor))
+
+def _publish(nodes, fun, arg, timeout):
+  """Run fun on the nodes through the master, with peer publishing"""
+  return __salt__['publish.publish'](','.join(nodes), fun, arg or [], expr_form='list', timeout=timeout)
+
+def _local_client(nodes, fun, arg, timeout):
+  """Run fun on the nodes from the master"""
+  import salt.client
+  client = salt.client.LocalClient(__opts__.get('conf_file', '/etc/salt/master'))
+  return client.cmd(nodes, fun, arg or [], timeout=timeout, expr_form='list')
+
+def _run_batch(run, nodes, fun, arg, timeout, concurrency):
+  """Run fun on the nodes of a batch, concurrency of them at a time"""
+  if not concurrency or concurrency >= len(nodes):
+    return run(nodes, fun, arg, timeout) or {}
+  return _run_each(run, nodes, fun, arg, timeout, concurrency)
+
+def _run_each(run, nodes, fun, arg, timeout, concurrency):
+  """Run fun on every node on its own, concurrency nodes at a time"""
+  pending = Queue.Queue()
+  for node in nodes:
+    pending.put(node)
+  results = {}
+  lock = threading.Lock()
+  def worker():
+    while True:
+      try:
+        node = pending.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        ret = run([node], fun, arg, timeout) or {}
+      except Exception, e:
+        log.error("Running {0} on {1} failed: {2}".format(fun, node, e))
+        ret = {}
+      with lock:
+        results.update(ret)
+
+  threads = [threading.Thread(target=worker) for i in range(min(concurrency, len(nodes)))]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  return results
+
+def _succeeded(ret):
+  """Check the return of a node: a state run has no failed states"""
+  if ret is None or ret is False:
+    return False
+  if isinstance(ret, list):
+    # Render errors come back as a list of strings
+    return False
+  if isinstance(ret, dict) and ret and all(isinstance(s, dict) and 'result' in s for s in ret.values()):
+    return all(s['result'] is not False for s in ret.values())
+  if isinstance(ret, dict) and 'result' in ret:
+    return ret['result'] is not False
+  return True
+
+def _unhealthy(run, nodes, check, timeout):
+  """The nodes failing the health check"""
+  if check.get('fun'):
+    expect = check.get('expect', True)
+    results = run(nodes, check['fun'], check.get('arg'), timeout) or {}
+    return [node for node in nodes if results.get(node) != expect]
+
+  ips = __salt__['informer.all']() if '{ip}' in check['url'] else {}
+  def check_url(node_list, url, arg, timeout):
+    healthy = {}
+    for node in node_list:
+      node_url = url.format(node=node, ip=ips.get(node, node))
+      healthy[node] = _healthy(node_url, check)
+      if not healthy[node]:
+        log.error("{0} failed its health check at {1}".format(node, node_url))
+    return healthy
+
+  # Every node waits out its own retries, so they are all checked at once
+  results = _run_each(check_url, nodes, check['url'], None, timeout, len(nodes))
+  return [node for node in nodes if not results.get(node)]
+
+def _healthy(url, check):
+  """Request url until it answers with the expected status"""
+  for attempt in range(int(check.get('retries', 10))):
+    if attempt:
+      time.sleep(float(check.get('interval', 3)))
+    try:
+      status = urllib2.urlopen(url, timeout=float(check.get('timeout', 5))).getcode()
+    except urllib2.HTTPError, e:
+      status = e.code
+    except Exception, e:
+      log.debug("Health check of {0} failed: {1}".format(url, e))
+      continue
+    if status == int(check.get('status', 200)):
+      return True
+  return False
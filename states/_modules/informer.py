@@ -1,7 +1,21 @@
 """
 This enables us to call the minions and search for a specific role
+
+The grains and addresses of every minion are fetched from the mine in one
+go and kept as an inventory, indexed by name, role and ip, for the rest of
+the run. Set informer_ttl in the minion config to also keep it on disk for
+that many seconds.
+
+query selects nodes by several grains at once:
+
+  salt['informer.query']('roles:redis and environment:production', 'ip')
+  salt['informer.query']({'roles': 'app', 'not': {'environment': 'staging'}})
 """
 
+import os
+import re
+import json
+import time
 import logging
 
 # Import salt libs
@@ -12,42 +26,219 @@ log = logging.getLogger(__name__)
 
 def get_roles(role, *args, **kwargs):
     """
-    Send the informer.is_role command to all minions
+    Get the names of the nodes with role
     """
-    ret = []
-    nodes = __salt__['mine.get']('*', 'grains.item')
-    print "-------------------------------> NODES {0}".format(nodes)
-    for name, node_details in nodes.iteritems():
-      name = _realname(name)
-      roles = node_details.get('roles', [])
-      if role in roles:
-        ret.append(name)
-
-    return ret
+    return sorted(inventory()['roles'].get(role, []))
 
 def get_node_grain_item(name, item):
   """Get the details of a node by the name nodename"""
-  name = _realname(name)
-  node = __salt__['mine.get'](name, 'grains.item')
-  print "NODE DETAILS ------> {0}: {1}".format(name, node[name])
-  return node[name][item]
+  return inventory()['nodes'][_realname(name)][item]
+
+def get_node_by_ip(ip):
+  """Get the name of the node with the address ip"""
+  return inventory()['by_ip'].get(ip)
 
 def all():
   """Get all the hosts and their ip addresses"""
-  ret = {}
-  nodes = __salt__['mine.get']('*', 'grains.item')
-  for name, node_details in nodes.iteritems():
+  return dict(inventory()['ips'])
+
+def query(selector, fields='name'):
+  """
+  The nodes matching selector, as a sorted list of names (fields='name'),
+  of ips (fields='ip'), a dict of name to a grain (fields='grain') or of
+  name to a dict of grains (fields=['grain', ...])
+
+  selector is either a string of grain:value terms combined with and, or,
+  not and parentheses, or a dict of grain to value (or a list of values,
+  any of which matches) that all have to match, with the keys and, or and
+  not for nested selectors. A term matches list grains such as roles when
+  the value is one of the items
+  """
+  snapshot = inventory()
+  if isinstance(selector, basestring):
+    selector = _parse_selector(selector)
+  names = sorted(_select(snapshot, selector))
+
+  if fields == 'name':
+    return names
+  if fields == 'ip':
+    return [snapshot['ips'][name] for name in names if name in snapshot['ips']]
+  if isinstance(fields, basestring):
+    return dict((name, snapshot['nodes'][name].get(fields)) for name in names)
+  return dict((name, dict((f, snapshot['nodes'][name].get(f)) for f in fields)) for name in names)
+
+def inventory(refresh=False):
+  """
+  The grains, addresses and roles of every node, fetched once per run
+  """
+  context = globals().get('__context__')
+  if context is not None and not refresh and 'informer.inventory' in context:
+    return context['informer.inventory']
+
+  ttl = __opts__.get('informer_ttl', 0)
+  snapshot = None if refresh or not ttl else _read_snapshot(ttl)
+  if snapshot is None:
+    snapshot = _build_snapshot()
+    if ttl:
+      _write_snapshot(snapshot)
+  if context is not None:
+    context['informer.inventory'] = snapshot
+  return snapshot
+
+def _build_snapshot():
+  """Fetch both mine functions for every node and index them"""
+  grains = __salt__['mine.get']('*', 'grains.item')
+  addrs = __salt__['mine.get']('*', 'network.ip_addrs')
+
+  nodes, ips, roles, by_ip = {}, {}, {}, {}
+  for name, node_details in grains.iteritems():
+    realname = _realname(name)
+    nodes[realname] = node_details
     if 'ec2_local-ipv4' in node_details:
-      ret[_realname(name)] = node_details['ec2_local-ipv4']
+      ip = node_details['ec2_local-ipv4']
+    else:
+      ip = (addrs.get(name) or [None])[0]
+    if ip:
+      ips[realname] = ip
+      by_ip[ip] = realname
+    node_roles = node_details.get('roles', [])
+    if not isinstance(node_roles, (list, tuple)):
+      node_roles = [node_roles]
+    for role in node_roles:
+      roles.setdefault(role, []).append(realname)
+
+  log.debug("Built the inventory of {0} nodes".format(len(nodes)))
+  return {'time': time.time(), 'nodes': nodes, 'ips': ips, 'roles': roles, 'by_ip': by_ip}
+
+def _select(snapshot, selector):
+  """The set of names matching a dict selector"""
+  matched = None
+  for key, value in selector.items():
+    if key == 'and':
+      names = _all_names(snapshot)
+      for s in value:
+        names = names & _select(snapshot, s)
+    elif key == 'or':
+      names = set()
+      for s in value:
+        names = names | _select(snapshot, s)
+    elif key == 'not':
+      names = _all_names(snapshot) - _select(snapshot, value)
     else:
-      ip = __salt__['mine.get'](name, 'network.ip_addrs')[name][0]
-      print "-----------------------------> {0}".format(ip)
-      ret[_realname(name)] = ip
-  return ret
-  
+      index = _grain_index(snapshot, key)
+      values = value if isinstance(value, (list, tuple, set)) else [value]
+      names = set()
+      for v in values:
+        names = names | index.get(_index_key(v), set())
+    matched = names if matched is None else matched & names
+  return matched if matched is not None else _all_names(snapshot)
+
+def _all_names(snapshot):
+  return set(snapshot['nodes'])
+
+def _grain_index(snapshot, grain):
+  """
+  The inverted index of grain, value to the set of names, built once per
+  snapshot and grain
+  """
+  indexes = snapshot.setdefault('_index', {})
+  if grain not in indexes:
+    index = {}
+    for name, node_details in snapshot['nodes'].iteritems():
+      value = node_details.get(grain)
+      values = value if isinstance(value, (list, tuple)) else [value]
+      for v in values:
+        if v is not None and not isinstance(v, dict):
+          index.setdefault(_index_key(v), set()).add(name)
+    indexes[grain] = index
+  return indexes[grain]
+
+def _index_key(value):
+  """Grain values compare as strings, so 2 matches the string '2'"""
+  if isinstance(value, bool):
+    return str(value).lower()
+  return unicode(value)
+
+_TOKEN_RE = re.compile(r'\s*(\(|\)|[^\s()]+)')
+
+def _parse_selector(text):
+  """Parse grain:value terms with and, or, not and parentheses into a dict selector"""
+  tokens = _TOKEN_RE.findall(text)
+  pos = [0]
+
+  def peek():
+    return tokens[pos[0]].lower() if pos[0] < len(tokens) else None
+
+  def take():
+    pos[0] += 1
+    return tokens[pos[0] - 1]
+
+  def expr():
+    terms = [conjunction()]
+    while peek() == 'or':
+      take()
+      terms.append(conjunction())
+    return terms[0] if len(terms) == 1 else {'or': terms}
+
+  def conjunction():
+    terms = [negation()]
+    while peek() not in (None, 'or', ')'):
+      if peek() == 'and':
+        take()
+      terms.append(negation())
+    return terms[0] if len(terms) == 1 else {'and': terms}
+
+  def negation():
+    if peek() == 'not':
+      take()
+      return {'not': negation()}
+    if peek() == '(':
+      take()
+      inner = expr()
+      if peek() != ')':
+        raise ValueError("Missing ) in {0}".format(text))
+      take()
+      return inner
+    token = take() if peek() is not None else ''
+    grain, sep, value = token.partition(':')
+    if not sep or not grain:
+      raise ValueError("Expected grain:value, got '{0}' in {1}".format(token, text))
+    return {grain: value}
+
+  selector = expr()
+  if pos[0] != len(tokens):
+    raise ValueError("Unexpected '{0}' in {1}".format(tokens[pos[0]], text))
+  return selector
+
+def _snapshot_file():
+  return os.path.join(__opts__.get('cachedir', '/var/cache/salt/minion'), 'informer_inventory.json')
+
+def _read_snapshot(ttl):
+  """The snapshot on disk, if it is younger than ttl seconds"""
+  try:
+    with open(_snapshot_file()) as f:
+      snapshot = json.load(f)
+  except (IOError, ValueError):
+    return None
+  if time.time() - snapshot.get('time', 0) > ttl:
+    return None
+  return snapshot
+
+def _write_snapshot(snapshot):
+  """Keep the snapshot on disk for the next runs"""
+  path = _snapshot_file()
+  tmp = '{0}.tmp-{1}'.format(path, os.getpid())
+  snapshot = dict((k, v) for k, v in snapshot.items() if not k.startswith('_'))
+  try:
+    with open(tmp, 'w') as f:
+      json.dump(snapshot, f)
+    os.rename(tmp, path)
+  except (IOError, OSError), e:
+    log.debug("Could not write the inventory to {0}: {1}".format(path, e))
+
 def _realname(name):
   """Basically a filter to get the 'real' name of a node"""
   if name == 'master':
     return 'saltmaster'
   else:
-    return name
\ No newline at end of file
+    return name
@@ -1,3 +1,13 @@
+import time
+import array
+
+# Values that are not counters: their rate means nothing, so rates reports
+# their own min/max/avg instead
+GAUGES = set([
+    'Ip:Forwarding', 'Ip:DefaultTTL',
+    'Tcp:RtoAlgorithm', 'Tcp:RtoMin', 'Tcp:RtoMax', 'Tcp:MaxConn', 'Tcp:CurrEstab'
+])
+
 def __virtual__():
     """
     Only run on Linux systems
@@ -10,6 +20,61 @@ def s():
     The netstat command is not needed: we use kernel-provided files directly.
     """
     stats = {}
+    for prefix, header, value in _read():
+        stats.setdefault(prefix, {})[header] = value
+    return stats
+
+def rates(interval=1, count=5, counters=None):
+    """
+    Sample the statistics of netstat -s count + 1 times, interval seconds
+    apart, and return for every counter its rate per second over the last
+    interval and the min, max and avg of the rates. counters limits the
+    result to a list or comma-separated string of names like
+    TcpExt:ListenOverflows.
+
+        salt '*' netstat.rates interval=1 count=30 counters=TcpExt:ListenOverflows,Tcp:RetransSegs
+    """
+    interval, count = float(interval), max(int(count), 1)
+
+    # The counters of the first sample fix the position of every counter
+    first = list(_read())
+    index = dict(('%s:%s' % (prefix, header), i) for i, (prefix, header, value) in enumerate(first))
+    names = sorted(index)
+    if counters:
+        if isinstance(counters, basestring):
+            counters = counters.split(',')
+        wanted = set(c.strip() for c in counters)
+        names = [n for n in names if n in wanted]
+
+    ring = _Ring(len(first), count + 1)
+    ring.append(time.time(), [value for prefix, header, value in first])
+    for i in range(count):
+        time.sleep(interval)
+        values = array.array('d', ring.last())
+        for prefix, header, value in _read():
+            pos = index.get('%s:%s' % (prefix, header))
+            if pos is not None:
+                values[pos] = value
+        ring.append(time.time(), values)
+
+    stats = {}
+    for name in names:
+        pos = index[name]
+        if name in GAUGES:
+            series = [ring.value(i, pos) for i in range(len(ring))]
+            entry = {'value': series[-1]}
+        else:
+            series = [(ring.value(i, pos) - ring.value(i - 1, pos)) / (ring.time(i) - ring.time(i - 1))
+                      for i in range(1, len(ring))]
+            entry = {'rate': series[-1]}
+        entry.update({'min': min(series), 'max': max(series), 'avg': sum(series) / len(series)})
+        prefix, header = name.split(':', 1)
+        stats.setdefault(prefix, {})[header] = entry
+
+    return {'interval': interval, 'samples': count, 'counters': stats}
+
+def _read():
+    """The (prefix, header, value) of every counter in /proc/net/netstat and /proc/net/snmp"""
     lines = open('/proc/net/netstat').readlines() + \
             open('/proc/net/snmp').readlines()
 
@@ -17,13 +82,45 @@ def s():
     for line in lines:
         sections = line.split(': ')
         prefix, list = sections[0], sections[1].strip()
-        stats.setdefault(prefix, {})
         items = list.split(' ')
         if currently_in_header_line:
             headers = items
         else:
             for pos in range(len(headers)):
-                stats[prefix][headers[pos]] = int(items[pos])
+                yield prefix, headers[pos], int(items[pos])
         currently_in_header_line = not currently_in_header_line
 
-    return stats
\ No newline at end of file
+class _Ring(object):
+    """
+    The last size samples of width counters each, in one flat array of
+    doubles, with their times
+    """
+    def __init__(self, width, size):
+        self.width = width
+        self.size = size
+        self.values = array.array('d', [0.0]) * (width * size)
+        self.times = array.array('d', [0.0]) * size
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, timestamp, values):
+        slot = self.count % self.size
+        self.values[slot * self.width:(slot + 1) * self.width] = array.array('d', values)
+        self.times[slot] = timestamp
+        self.count += 1
+
+    def _slot(self, i):
+        """The slot of the i-th oldest sample kept"""
+        return (self.count - len(self) + i) % self.size
+
+    def value(self, i, pos):
+        return self.values[self._slot(i) * self.width + pos]
+
+    def time(self, i):
+        return self.times[self._slot(i)]
+
+    def last(self):
+        slot = (self.count - 1) % self.size
+        return self.values[slot * self.width:(slot + 1) * self.width]
@@ -6,9 +6,31 @@ Support for deploying an application
 import os
 import argparse
 import re
+import json
+import time
+import hashlib
 import logging
 import tempfile
 import shutil
+import subprocess
+import threading
+import traceback
+import contextlib
+import fcntl
+import multiprocessing
+import Queue
+import stat
+import filecmp
+import signal
+import select
+import errno
+import glob
+import collections
+import urllib
+import urllib2
+import tarfile
+import ctypes
+import ctypes.util
 from pwd import getpwnam
 from grp import getgrnam
 
@@ -18,29 +40,151 @@ from salt.exceptions import SaltException
 
 log = logging.getLogger(__name__)
 
+CLOCK_MONOTONIC = 1
+
+SHA_RE = re.compile(r'^[0-9a-f]{40}$')
+SHORT_SHA_RE = re.compile(r'^[0-9a-f]{7,39}$')
+
+RVM_PATH   = '/usr/local/rvm'
+RVM_SCRIPT = os.path.join(RVM_PATH, 'scripts', 'rvm')
+# The variables `rvm use` sets that commands need, besides the rvm_* ones
+RUBY_ENV_VARS = ['PATH', 'GEM_HOME', 'GEM_PATH', 'RUBY_VERSION', 'MY_RUBY_HOME', 'IRBRC']
+# Resolved rvm environments, by (ruby[@gemset], user)
+_RUBY_ENVIRONS = {}
+
+# Seconds every command of a phase may take, unless deploy.rails is given
+# other timeouts. None waits forever
+PHASE_TIMEOUTS = {
+  'default': 600,
+  'deploy_repo': 1800,
+  'bundle_install': 3600,
+  'migrate': 3600,
+  'after_migrate': 3600,
+  # Asking the remote for the sha of the revision, also before the phases
+  'resolve_revision': 120
+}
+# Lines of stdout and stderr of a command kept in memory
+OUTPUT_TAIL = 200
+# Seconds between the TERM and the KILL of a command that timed out
+KILL_GRACE = 10
+
+# Unicorn sizing, in MB: the RSS of a worker when none could be measured and
+# the memory left to the system besides the services sharing the host
+DEFAULT_WORKER_RSS = 300
+BASE_HEADROOM = 512
+# Connections queued per worker, up to net.core.somaxconn
+BACKLOG_PER_WORKER = 64
+
+# Everything that goes into assets:precompile, relative to the release
+ASSET_INPUTS = [
+  'app/assets',
+  'lib/assets',
+  'vendor/assets',
+  'Gemfile.lock',
+  'config/application.rb',
+  'config/environments/{rails_env}.rb',
+  'config/initializers/assets.rb'
+]
+# Directories of a release with runtime files that get written in place,
+# never hardlinked to the previous release
+DEDUP_SKIP = ['tmp', 'log', 'db']
+# The asset manifests of sprockets 2 to 4, which map logical paths to the
+# digested files of one compile
+ASSET_MANIFESTS = ['manifest.yml', 'manifest-*.json', '.sprockets-manifest-*.json']
+
 ## This is the rails object
 # For the time being, I'm just getting this working, but will need to 
 # come back later and abstract this to handle multiple application types
 
+class DeployError(SaltException):
+  """A deploy phase failed"""
+  pass
+
 class App(object):
   """Application deployment"""
   def __init__(self, opts):
     super(App, self).__init__()
     self.opts = opts
+    self.timeline = []
+    self._local = threading.local()
+    self._started = _monotonic()
   
   def deploy(self):
     """Call deploy"""
-    self.before_deploy()
-    self.deploy_repo()
-    self.after_deploy()
-    
-    self.before_migrate()
-    self.migrate()
-    self.after_migrate()
-    
-    self.before_launch()
-    self.launch()
-    self.after_launch()
+    self.timeline = []
+    self._started = _monotonic()
+    phases = [(name, self._timed_phase(name, fn), deps) for name, fn, deps in self.phases()]
+    return _run_phases(phases, self.opts.get('concurrency', 1))
+
+  def _timed_phase(self, name, fn):
+    """Wrap a phase so it gets an entry in the timeline"""
+    def timed():
+      entry = {'phase': name, 'start': None, 'duration': None, 'result': None,
+               'skipped': False, 'cached': False, 'exit_code': None, 'steps': []}
+      self.timeline.append(entry)
+      self._local.phase = entry
+      start = _monotonic()
+      entry['start'] = round(start - self._started, 3)
+      timeout = self._phase_timeout(name)
+      self._local.deadline = start + timeout if timeout else None
+      try:
+        fn()
+        entry['result'] = True
+      except Exception:
+        entry['result'] = False
+        raise
+      finally:
+        entry['duration'] = round(_monotonic() - start, 3)
+        self._local.phase = None
+        self._local.deadline = None
+    return timed
+
+  def _phase_timeout(self, name):
+    """Seconds the commands of phase name may take altogether"""
+    timeouts = dict(PHASE_TIMEOUTS)
+    timeouts.update(self.opts.get('timeouts') or {})
+    return timeouts.get(name, timeouts.get('default'))
+
+  def _record_step(self, kind, name, start, exit_code=None):
+    """Add a command or salt call that started at start to the running phase"""
+    entry = getattr(self._local, 'phase', None)
+    if entry is None:
+      return
+    entry['steps'].append({
+      kind: name,
+      'start': round(start - self._started, 3),
+      'duration': round(_monotonic() - start, 3),
+      'exit_code': exit_code
+    })
+    if exit_code is not None:
+      entry['exit_code'] = exit_code
+
+  def _flag_phase(self, flag):
+    """Flag the running phase as skipped or cached"""
+    entry = getattr(self._local, 'phase', None)
+    if entry is not None:
+      entry[flag] = True
+
+  def phases(self):
+    """
+      The deploy lifecycle as a list of (name, callable, dependencies). A
+      phase runs as soon as all of its dependencies are done
+    """
+    hooks = ['before_deploy', 'deploy_repo', 'after_deploy',
+             'before_migrate', 'migrate', 'after_migrate',
+             'before_launch', 'launch', 'after_launch']
+    phases = []
+    for i, hook in enumerate(hooks):
+      phases.append((hook, getattr(self, hook), hooks[i-1:i]))
+    return phases
+
+  def deploy_repo(self):
+    """Get the application code"""
+    pass
+
+  def migrate(self):
+    """Migrate"""
+    pass
     
   def launch(self):
     """Launch!"""
@@ -80,6 +224,7 @@ class Rails(App):
     self.repo         = opts['repo']
     self.docroot      = opts['docroot']
     self.ruby_version = opts['ruby_version']
+    self.gemset       = opts['gemset']
     self.server       = opts['server']
     self.database     = opts['database']
     self.ssl          = opts['ssl']
@@ -89,19 +234,45 @@ class Rails(App):
     self.deploy_key   = opts['deploy_key']
     self.deploy_port  = opts['deploy_port']
     self.revision     = opts['revision']
+    self.revision_ttl = opts['revision_ttl']
+    self.migration_check = opts['migration_check']
+    self.rake_tasks   = opts['rake_tasks']
+    self.keep_releases  = opts['keep_releases']
+    self.dedup_releases = opts['dedup_releases']
+    self.artifact     = opts['artifact']
+    self.artifact_mode = self.artifact.get('mode')
     self.symlinks     = opts['symlinks']
     self.config_templates = opts['config_templates']
     self.kwargs       = opts['kwargs']
-    self.salt         = opts['salt']
+    self.salt         = _TimedLoader(opts['salt'], self._record_step)
     self.grains       = opts['grains']
+    self.cachedir     = opts['cachedir']
     
     ## Don't mess with the rest
     self.release_path = os.path.join(self.docroot, 'releases')
     self.shared_path  = os.path.join(self.docroot, 'shared')
     self.current_path = os.path.join(self.docroot, 'current')
+    self.mirror_path  = os.path.join(self.shared_path, 'cached-copy.git')
+    self.submodule_mirror_path = os.path.join(self.shared_path, 'cached-submodules')
+    self.revision_cache_file   = os.path.join(self.shared_path, 'system', 'revisions.json')
+    self.bundle_fingerprint_file = os.path.join(self.shared_path, 'system', 'bundle.fingerprint')
+    self.shared_bundle_config    = os.path.join(self.shared_path, 'system', 'bundle_config')
+    self.toolchain_file          = os.path.join(self.cachedir, 'deploy_toolchain.json')
+    self.fingerprint_file        = os.path.join(self.shared_path, 'system', 'deploy.fingerprint')
+    self.unicorn_sizing_file     = os.path.join(self.shared_path, 'system', 'unicorn_sizing.json')
+    self.unicorn_sizing          = None
+    self.deploy_log              = None
+    self._deploy_log             = None
+    self._log_lock               = threading.Lock()
     
     self.deploy_key_file          = ''
     self.git_deploy_wrapper_file  = ''
+    if self.gemset:
+      self.ruby_env_name = '%s@%s' % (self.ruby_version, self.gemset)
+    else:
+      self.ruby_env_name = self.ruby_version
+    self._rake_task_cache         = {}
+    self._rake_lock               = threading.Lock()
     
     if opts['env'] is None:
       self.env = self.kwargs.get('__env__', 'base')
@@ -109,30 +280,148 @@ class Rails(App):
       self.env = opts['env']
       
   def deploy(self):
-    """Deploy"""
-    return super(Rails, self).deploy()
+    """Deploy, with the output of every command in a log of its own"""
+    self._open_deploy_log()
+    try:
+      return super(Rails, self).deploy()
+    finally:
+      self._close_deploy_log()
+
+  def _open_deploy_log(self):
+    """Open shared/log/deploy-<time>.log, keeping the last keep_releases logs"""
+    log_dir = os.path.join(self.shared_path, 'log')
+    if not os.path.isdir(log_dir):
+      self.makedir_please(log_dir)
+    logs = sorted(f for f in os.listdir(log_dir) if f.startswith('deploy-') and f.endswith('.log'))
+    for f in logs[:max(len(logs) - self.keep_releases + 1, 0)]:
+      os.remove(os.path.join(log_dir, f))
+
+    self.deploy_log = os.path.join(log_dir, time.strftime('deploy-%Y%m%d%H%M%S.log'))
+    try:
+      self._deploy_log = open(self.deploy_log, 'a')
+      self.salt['file.chown'](self.deploy_log, self.user, self.group)
+    except IOError, e:
+      log.warning("Could not open the deploy log %s: %s" % (self.deploy_log, e))
+      self.deploy_log = self._deploy_log = None
+
+  def _close_deploy_log(self):
+    with self._log_lock:
+      if self._deploy_log:
+        self._deploy_log.close()
+        self._deploy_log = None
+
+  def _log_output(self, stream, line):
+    """Forward a line of command output to the log and the deploy log"""
+    entry = getattr(self._local, 'phase', None)
+    phase = entry['phase'] if entry else '-'
+    log.debug("[%s] %s: %s" % (phase, stream, line))
+    with self._log_lock:
+      if self._deploy_log:
+        self._deploy_log.write("%s [%s] %s: %s\n" % (time.strftime('%H:%M:%S'), phase, stream, line))
+        self._deploy_log.flush()
+
+  def phases(self):
+    """The phases of a deploy in the artifact mode, if any"""
+    if self.artifact_mode == 'build':
+      return self.build_phases()
+    if self.artifact_mode == 'fetch':
+      return self.fetch_phases()
+    return self.deploy_phases()
+
+  # The phases that make up each of the before_ hooks
+  HOOK_PHASES = [
+    ('before_deploy',  ['path_structure', 'config_templates', 'ssl', 'rvm', 'deploy_key']),
+    ('before_migrate', ['database_yml', 'symlinks', 'bundle_install']),
+    ('before_launch',  ['webserver', 'link_current'])
+  ]
+
+  def deploy_phases(self):
+    """
+      The hooks split in the steps that actually depend on each other, so
+      that for instance the templates and rvm run alongside the clone and the
+      database.yml and symlinks alongside bundle install. A before_ hook a
+      subclass overrides runs as a single phase in place of its steps
+    """
+    phases = [
+      ('path_structure',   self._create_path_structure,    []),
+      ('config_templates', self._create_templates,         ['path_structure']),
+      ('ssl',              self._setup_ssl_if_necessary,   ['path_structure']),
+      ('rvm',              self._install_rvm_if_necessary, []),
+      ('deploy_key',       self._create_deploy_file_if_necessary, ['path_structure']),
+      ('deploy_repo',      self.deploy_repo,               ['deploy_key']),
+      ('after_deploy',     self.after_deploy,              ['deploy_repo']),
+      ('database_yml',     self._create_database_yml,      ['path_structure']),
+      ('symlinks',         self._create_symlinks,          ['after_deploy', 'config_templates', 'database_yml']),
+      ('bundle_install',   self._run_bundle_install,       ['after_deploy', 'rvm']),
+      ('migrate',          self.migrate,                   ['symlinks', 'bundle_install']),
+      # Precompile and the extra rake tasks boot the app against the schema
+      ('after_migrate',    self.after_migrate,             ['migrate']),
+      # unicorn.rb is live config, only point it at a release that built
+      ('webserver',        self._setup_webserver_if_necessary, ['migrate', 'after_migrate', 'rvm', 'config_templates']),
+      ('link_current',     self._link_to_current_dir,      ['migrate', 'after_migrate', 'webserver', 'ssl']),
+      ('launch',           self.launch,                    ['link_current']),
+      ('after_launch',     self.after_launch,              ['launch'])
+    ]
+    for hook, steps in self.HOOK_PHASES:
+      if getattr(type(self), hook).im_func is not getattr(Rails, hook).im_func:
+        phases = _merge_phases(phases, hook, getattr(self, hook), steps)
+    return phases
+
+  def build_phases(self):
+    """
+      The phases of the builder in artifact mode: the release is cloned,
+      bundled and its assets compiled, then published to the artifact store.
+      Nothing is migrated or launched
+    """
+    return [
+      ('path_structure',   self._create_path_structure,    []),
+      ('config_templates', self._create_templates,         ['path_structure']),
+      ('rvm',              self._install_rvm_if_necessary, []),
+      ('deploy_key',       self._create_deploy_file_if_necessary, ['path_structure']),
+      ('deploy_repo',      self.deploy_repo,               ['deploy_key']),
+      ('after_deploy',     self.after_deploy,              ['deploy_repo']),
+      ('database_yml',     self._create_database_yml,      ['path_structure']),
+      ('symlinks',         self._create_symlinks,          ['after_deploy', 'config_templates', 'database_yml']),
+      ('bundle_install',   self._run_bundle_install,       ['after_deploy', 'rvm']),
+      ('assets',           self._build_assets,             ['symlinks', 'bundle_install']),
+      ('publish',          self.publish_artifact,          ['assets']),
+      ('cleanup',          self._cleanup_releases,         ['publish'])
+    ]
+
+  def fetch_phases(self):
+    """
+      The phases of the other nodes in artifact mode: the release and its
+      bundle are unpacked from the artifact store instead of cloned and
+      built, the bundle install and asset gates then find nothing to do
+    """
+    phases = []
+    for name, fn, deps in self.deploy_phases():
+      if name == 'deploy_key':
+        continue
+      if name == 'deploy_repo':
+        name, fn, deps = 'fetch_artifact', self.fetch_artifact, ['path_structure']
+      phases.append((name, fn, ['fetch_artifact' if d == 'deploy_repo' else d for d in deps]))
+    return phases
     
   def before_deploy(self):
     """Before deploy callback"""
     self._create_path_structure()
-    self._create_config_templates()
+    self._create_templates()
     self._setup_ssl_if_necessary()
     
     self._install_rvm_if_necessary()
-    
-    if self.deploy_key:
-      self._create_deploy_file()
+    self._create_deploy_file_if_necessary()
       
   def deploy_repo(self):
     """Deploy the repo"""
     ## Get the current sha
     self.get_current_sha()
+    self.previous_release = self._previous_release_path()
     
     if not self.has_been_pulled():
       ## Now we're going to actually pull the repo
       deploy_path = self.git_pull()
       log.debug("Cloned the repository to: %s" % deploy_path)
-      self.get_current_sha()
     else:
       self.git_update()
       
@@ -144,29 +433,230 @@ class Rails(App):
     self._run_bundle_install()
     
   def migrate(self):
-    """Migrate"""
+    """Migrate, if the release brings new or changed migrations"""
+    manifest_file = os.path.join(self.revision_path, '.migrations_manifest')
+    manifest = self._migrations_manifest(self.revision_path)
+
+    if not self._has_pending_migrations(manifest):
+      log.debug("No new migrations, skipping db:migrate")
+      self._flag_phase('skipped')
+      self._write_marker(manifest_file, json.dumps(manifest))
+      return
+
     log.debug("calling db:migrate")
-    self._run_rake("db:migrate")
+    if self._run_rake("db:migrate"):
+      self._write_marker(manifest_file, json.dumps(manifest))
     
   def after_migrate(self):
     """Callback after migrations"""
-    self._run_rake("assets:precompile")
+    # assets:precompile and the extra rake tasks share a single app boot
+    tasks = list(self.rake_tasks)
+    assets_digest = self._prepare_assets()
+    if assets_digest:
+      tasks.insert(0, 'assets:precompile')
+
+    if tasks and self._run_rake(*tasks) and assets_digest:
+      self._assets_compiled(assets_digest)
   
   def before_launch(self):
     """Callback before launch"""
     #### Enhancement for the future: check what to serve 
     ## For now, just use unicorn
-    log.debug("server: %s" % self.server)
-    if self.server:
-      log.debug("Setting up server")
-      self._setup_webserver()
-    
+    self._setup_webserver_if_necessary()
     self._link_to_current_dir()
     
+  def launch(self):
+    """Launch"""
+    if self.server:
+      self._reload_webserver()
+
   def after_launch(self):
     """Callback after launch"""
-    pass
+    if self.dedup_releases:
+      self._dedup_release()
+    self._cleanup_releases()
+
+  def _dedup_release(self):
+    """
+      Replace the files of the new release that are identical to the ones in
+      the previous release with hardlinks to them. Only the files of the
+      repository or the artifact are, runtime files stay apart
+    """
+    previous = getattr(self, 'previous_release', None)
+    if not previous or not os.path.isdir(previous):
+      return 0
+
+    saved = 0
+    for relpath in self._release_files():
+      if relpath.split('/')[0] in DEDUP_SKIP:
+        continue
+      path = os.path.join(self.revision_path, relpath)
+      other = os.path.join(previous, relpath)
+      try:
+        st, other_st = os.lstat(path), os.lstat(other)
+      except OSError:
+        continue
+      if not stat.S_ISREG(st.st_mode) or not stat.S_ISREG(other_st.st_mode):
+        continue
+      if (st.st_dev, st.st_ino) == (other_st.st_dev, other_st.st_ino) or st.st_dev != other_st.st_dev:
+        continue
+      if (st.st_size, st.st_mode, st.st_uid, st.st_gid) != (other_st.st_size, other_st.st_mode, other_st.st_uid, other_st.st_gid):
+        continue
+      if not filecmp.cmp(path, other, shallow=False):
+        continue
+      tmp = path + '.dedup'
+      try:
+        os.link(other, tmp)
+        os.rename(tmp, path)
+        saved += st.st_size
+      except OSError, e:
+        log.debug("Could not hardlink %s: %s" % (path, e))
+        if os.path.lexists(tmp):
+          os.remove(tmp)
+    log.debug("Hardlinked %s bytes of %s to %s" % (saved, self.revision_path, previous))
+    return saved
+
+  def _release_files(self):
+    """The files git tracks in the release, or the ones of the artifact it was unpacked from"""
+    if os.path.isdir(os.path.join(self.revision_path, '.git')):
+      lines = self._cmd("git -c core.quotepath=off ls-files", cwd=self.revision_path, tail=None)
+      if self.last_retcode != 0:
+        return []
+      # Names git still quotes have characters not worth handling here
+      return [l for l in lines.splitlines() if l and not l.startswith('"')]
+    listing = self._read_marker(os.path.join(self.revision_path, '.artifact_files'))
+    return listing.split('\0') if listing else []
+
+  def _cleanup_releases(self):
+    """
+      Remove all but the keep_releases newest releases, never the live one.
+      The old releases are moved out of the way and deleted in the background
+    """
+    live = set([os.path.realpath(self.revision_path)])
+    if os.path.islink(self.current_path):
+      live.add(os.path.realpath(self.current_path))
+
+    releases = []
+    trash = []
+    for d in os.listdir(self.release_path):
+      path = os.path.join(self.release_path, d)
+      if d.startswith('.trash-'):
+        trash.append(path)
+      elif os.path.isdir(path) and not os.path.islink(path):
+        releases.append(path)
+    releases.sort(key=lambda r: os.path.getmtime(r), reverse=True)
+
+    for path in releases[max(self.keep_releases, 1):]:
+      if os.path.realpath(path) in live:
+        continue
+      target = os.path.join(self.release_path, '.trash-%s-%s' % (os.path.basename(path), os.getpid()))
+      log.debug("Removing old release %s" % path)
+      os.rename(path, target)
+      trash.append(target)
+
+    if trash:
+      devnull = open(os.devnull, 'w')
+      subprocess.Popen(['nice', '-n', '19', 'rm', '-rf'] + trash,
+        stdin=devnull, stdout=devnull, stderr=devnull,
+        close_fds=True, preexec_fn=os.setsid)
+    return trash
     
+  def deploy_fingerprint(self):
+    """
+      Fingerprint of everything that goes into a deploy: the resolved sha,
+      the rendered templates, the ruby and the settings
+    """
+    if self.deploy_key and not self.git_deploy_wrapper_file:
+      wrapper = os.path.join(self.docroot, 'git_deploy_wrapper.sh')
+      if os.path.isfile(wrapper):
+        self.git_deploy_wrapper_file = wrapper
+    self.get_current_sha()
+    return self._fingerprint()
+
+  def _fingerprint(self):
+    """Fingerprint of the templates and settings of the resolved sha"""
+    digest = hashlib.sha1()
+    specs = self._template_specs()
+    # One fetch for every source, render then only reads the local copies
+    self.salt['deploy_template.prefetch']([source for path, source, mode, defaults in specs], env=self.env)
+    for path, source, mode, defaults in specs:
+      rendered = self.salt['deploy_template.render'](source, env=self.env, defaults=defaults)
+      digest.update('%s\0%s\0%s\0%s\0' % (path, source, mode, rendered))
+    settings = {
+      'sha': self.sha,
+      'ruby_version': self.ruby_version,
+      'gemset': self.gemset,
+      'server': self.server,
+      'rails_env': self.rails_env,
+      'symlinks': self.symlinks,
+      'rake_tasks': self.rake_tasks,
+      'deploy_port': self.deploy_port,
+      'user': self.user,
+      'group': self.group
+    }
+    digest.update(json.dumps(settings, sort_keys=True))
+    return digest.hexdigest()
+
+  def is_deployed(self, fingerprint):
+    """Check if current is the release recorded with fingerprint"""
+    if self.artifact_mode == 'build':
+      # The builder never links current, it is done once the artifact is out
+      return self._read_marker(self.fingerprint_file) == '%s %s' % (self.sha, fingerprint) and \
+        self._store_read(self._artifact_key('releases', self.sha + '.json')) is not None
+    if not os.path.islink(self.current_path):
+      return False
+    if os.path.realpath(self.current_path) != os.path.realpath(self.revision_path):
+      return False
+    return self._read_marker(self.fingerprint_file) == '%s %s' % (self.sha, fingerprint)
+
+  def record_fingerprint(self):
+    """
+      Record the fingerprint of the release that was just deployed. It is
+      taken again as the deploy may have measured a new unicorn sizing
+    """
+    self._write_marker(self.fingerprint_file, '%s %s' % (self.sha, self._fingerprint()))
+
+  def planned_phases(self):
+    """
+      The phases a deploy would run, with the ones it is known to skip. The
+      gates are only checked when the release has been pulled already
+    """
+    plan = [[name, 'run'] for name, fn, deps in self.phases()]
+    if not os.path.isdir(self.revision_path):
+      return plan
+
+    skip = set()
+    if self._bundle_is_current(self._bundle_fingerprint(['development test'])):
+      skip.add('bundle_install')
+    if not self._has_pending_migrations(self._migrations_manifest(self.revision_path), check_database=False):
+      skip.add('migrate')
+    digest = self._assets_digest()
+    previous = self._previous_release_path()
+    releases = [self.revision_path] + ([previous] if previous else [])
+    if not self.rake_tasks and digest in [self._read_marker(os.path.join(r, '.assets_digest')) for r in releases]:
+      skip.add('after_migrate')
+    for phase in plan:
+      if phase[0] in skip:
+        phase[1] = 'skip'
+    return plan
+
+  def _create_templates(self):
+    """Fetch the templates and create the config templates"""
+    self._prefetch_templates()
+    self._create_config_templates()
+
+  def _create_deploy_file_if_necessary(self):
+    """Create the deploy key and git wrapper if a deploy key is given"""
+    if self.deploy_key:
+      self._create_deploy_file()
+
+  def _setup_webserver_if_necessary(self):
+    """Setup the webserver if a server is given"""
+    log.debug("server: %s" % self.server)
+    if self.server:
+      log.debug("Setting up server")
+      self._setup_webserver()
+
   ## Create the path structure at the docroot
   def _create_path_structure(self):
     """Create the basic shared path structure"""
@@ -193,6 +683,21 @@ class Rails(App):
   def _install_rvm_if_necessary(self):
     ## Now, let's do the before, thinkgs like symlinking
     # Make sure the ruby version is correct and available
+    toolchain = self._read_toolchain()
+    if toolchain is not None and self._toolchain_is_complete(toolchain):
+      log.debug("Toolchain record is current, not asking rvm")
+      self._flag_phase('cached')
+      return
+
+    # Deploys sharing the host share rvm, only one of them may change it
+    with _file_lock(os.path.join(self.cachedir, 'deploy_toolchain.lock')):
+      toolchain = self._read_toolchain()
+      if toolchain is not None and self._toolchain_is_complete(toolchain):
+        return
+      self._install_rvm()
+
+  def _install_rvm(self):
+    """Install rvm, the ruby, its gemset, bundler and unicorn as needed"""
     if not self.salt['rvm.is_installed']():
       self.salt['rvm.install']()
 
@@ -205,6 +710,90 @@ class Rails(App):
       # self._cmd("chown -R %s /usr/local/rvm" % self.user, {'user': 'root'})
       self.salt['rvm.gemset_create'](self.ruby_version, self.name, runas=self.user)
       self.salt['rvm.do'](self.ruby_version, 'gem install bundler --no-ri --no-rdoc')
+      # Anything resolved before the install is stale
+      _RUBY_ENVIRONS.clear()
+      rubies = self.salt['rvm.list'](runas=self.user)
+
+    if self.gemset and self.gemset not in self.salt['rvm.gemset_list'](self.ruby_version, runas=self.user):
+      self.salt['rvm.gemset_create'](self.ruby_version, self.gemset, runas=self.user)
+
+    unicorn = None
+    if self.server:
+      unicorn = self.salt['rvm.do'](self.ruby_version, 'gem install unicorn --no-ri --no-rdoc') is not False
+
+    self._record_toolchain([r[1] for r in rubies], unicorn)
+
+  def _toolchain_is_complete(self, toolchain):
+    """Check if the recorded toolchain has everything this deploy needs"""
+    if self.ruby_version not in toolchain.get('rubies', []):
+      return False
+    if self.gemset and self.gemset not in toolchain.get('gemsets', {}).get(self.ruby_version, []):
+      return False
+    if self.server and not toolchain.get('unicorn', {}).get(self.ruby_version):
+      return False
+    return bool(toolchain.get('bundler', {}).get(self.ruby_version))
+
+  def _toolchain_stamp(self):
+    """Modification times of the rvm directories that change when rubies or gemsets do"""
+    stamp = {}
+    for d in ['rubies', 'gems']:
+      try:
+        stamp[d] = os.stat(os.path.join(RVM_PATH, d)).st_mtime
+      except OSError:
+        return None
+    return stamp
+
+  def _read_toolchain(self):
+    """
+      The recorded rubies, gemsets and bundler versions, or None if rvm has
+      changed since they were recorded
+    """
+    if not os.path.isfile(RVM_SCRIPT):
+      return None
+    try:
+      with open(self.toolchain_file) as f:
+        toolchain = json.load(f)
+    except (IOError, ValueError):
+      return None
+    stamp = self._toolchain_stamp()
+    if stamp is None or toolchain.get('stamp') != stamp:
+      return None
+    return toolchain
+
+  def _record_toolchain(self, rubies, unicorn=None):
+    """
+      Record the rubies, the gemsets and the bundler version of this ruby,
+      and whether unicorn is installed for it unless unicorn is None
+    """
+    try:
+      with open(self.toolchain_file) as f:
+        toolchain = json.load(f)
+    except (IOError, ValueError):
+      toolchain = {}
+
+    gemsets = toolchain.get('gemsets', {})
+    gemsets[self.ruby_version] = self.salt['rvm.gemset_list'](self.ruby_version, runas=self.user)
+    bundler = toolchain.get('bundler', {})
+    version = self._cmd("bundle --version", cwd='/tmp')
+    bundler[self.ruby_version] = version.split()[-1] if self.last_retcode == 0 and version else None
+    unicorns = toolchain.get('unicorn', {})
+    if unicorn is not None:
+      unicorns[self.ruby_version] = unicorn
+
+    toolchain = {
+      'rubies': rubies,
+      'gemsets': gemsets,
+      'bundler': bundler,
+      'unicorn': unicorns,
+      'stamp': self._toolchain_stamp()
+    }
+    tmp = self.toolchain_file + '.%s' % os.getpid()
+    try:
+      with open(tmp, 'w') as f:
+        json.dump(toolchain, f)
+      os.rename(tmp, self.toolchain_file)
+    except (IOError, OSError), e:
+      log.debug("Could not record the toolchain: %s" % e)
     
   # Create a deploy key
   def _create_deploy_file(self):
@@ -217,76 +806,128 @@ class Rails(App):
     self._handle_salt_template(deploy_key_file, 'salt://states_templates/id_deploy', 600, {'deploy_key': self.deploy_key})
     self.deploy_key_file = deploy_key_file
 
-    # Now we'll create the git_deploy_wrapper
-    source = 'salt://states_templates/git_deploy_wrapper'
-    defaults = {'id_deploy': deploy_key_file, 'port': self.deploy_port}
-
-    self._handle_salt_template(git_deploy_wrapper_file, source, 755, defaults)
+    # The git_deploy_wrapper shares one ssh connection between the git commands
+    self.salt['deploy_ssh.wrapper'](git_deploy_wrapper_file, deploy_key_file,
+      port=self.deploy_port,
+      user=self.user,
+      group=self.group,
+      env=self.env)
      
     self.git_deploy_wrapper_file = git_deploy_wrapper_file
     return git_deploy_wrapper_file
+
+  def close_connections(self):
+    """Close the ssh connection the git commands shared"""
+    if self.deploy_key:
+      self.salt['deploy_ssh.close'](os.path.join(self.docroot, 'id_deploy'))
       
   def _handle_salt_template(self, path, source, mode, defaults={}):
-    template = 'jinja'
-    backup = ''
-    # source_hash = self.salt['file.get_hash'](path)
-    # log.debug("""---- source_hash ----
-    #   source_hash: {hash}
-    # """.format(hash=source_hash))
-    source, source_hash = self.salt['file.source_list'](source,'',self.env)
-    sfn, source_sum, comment = self.salt['file.get_managed'](path,
-      template,
-      source,
-      source_hash,
-      self.user,
-      self.group,
-      mode,
-      self.env,
-      defaults,
-      {})
-    ret = {'name': self.name, 'result': None, 'comment': '', 'changes': {}}
-    try:
-      log.debug(
-        """---- file.manage_file ----
-          path: {path}
-          sfn: {sfn}
-          ret: {ret}
-          source: {source}
-          source_sum: {source_sum}
-          source_hash: {source_hash}
-          user: {user}
-          group: {group}
-          mode: {mode}
-          env: {env}
-          backup: {backup}
-          comment: {comment}
-        """.format(path=path, sfn=sfn, ret=ret, source=source, source_sum=source_sum, user=self.user, group=self.group, mode=mode, env=self.env, backup=backup, source_hash=source_hash,
-          defaults=defaults,comment=comment)
-      )
-      ret = self.salt['file.manage_file'](path, sfn, ret, source, source_sum, self.user, self.group, mode, self.env, backup)
-      log.debug("""ret for manage_file: {ret}""".format(ret=ret))
-    except Exception, e:
-      log.error("Something went wrong :( {comment} / {exception}".format(comment=ret['comment'], exception=e))
-      raise e
-    
-    return ret
+    """Render a template from the master to path"""
+    return self.salt['deploy_template.manage'](path, source, mode,
+      user=self.user,
+      group=self.group,
+      env=self.env,
+      defaults=defaults)
+
+  def _prefetch_templates(self):
+    """Fetch every template this deploy renders from the master in one batch"""
+    sources = ['salt://states_templates/database.yml']
+    if self.server:
+      sources.append('salt://states_templates/unicorn_rb')
+    if self.deploy_key:
+      sources.extend(['salt://states_templates/id_deploy', 'salt://states_templates/git_deploy_wrapper'])
+    for c in self.config_templates:
+      sources.append(self.config_templates[c].format(environment=self.grains['environment']))
+    return self.salt['deploy_template.prefetch'](sources, env=self.env)
     
   def get_current_sha(self):
    """
    Get the current revision
    """
-   cmd = r"GIT_SSH={git_ssh} git ls-remote {repo}".format(git_ssh=self.git_deploy_wrapper_file, repo=self.repo)
-   lines = self.salt['cmd.run_stdout'](cmd, runas=self.user)
-   log.debug("get_current_sha: %s" % lines)
+   if self.artifact_mode == 'fetch':
+     sha = self._resolve_artifact_revision(self.revision)
+   else:
+     sha = self._resolve_revision(self.repo, self.revision)
+   log.debug("get_current_sha: %s -> %s" % (self.revision, sha))
+   if sha is None:
+     raise SaltException("Could not resolve revision %s of %s" % (self.revision, self.repo))
 
-   for line in lines.splitlines():
-     sha, branch = line.split('\t')
-     if self.revision in branch:
-       self.sha = sha
-       self.revision_path = os.path.join(self.release_path, sha)
-       return sha
+   self.sha = sha
+   self.revision_path = os.path.join(self.release_path, sha)
+   return sha
 
-   return None
+  def _resolve_revision(self, repo, revision):
+    """
+      Resolve a branch, tag or sha to a sha, asking the remote only for the
+      exact refs and caching the answer for revision_ttl seconds
+    """
+    if SHA_RE.match(revision):
+      return revision
+
+    cache = self._read_revision_cache()
+    key = "%s %s" % (repo, revision)
+    cached = cache.get(key)
+    if cached and time.time() - cached[1] < self.revision_ttl:
+      log.debug("Using cached sha %s for %s" % (cached[0], key))
+      self._flag_phase('cached')
+      return cached[0]
+
+    if revision.startswith('refs/'):
+      candidates = [revision + '^{}', revision]
+    else:
+      candidates = ['refs/heads/%s' % revision, 'refs/tags/%s^{}' % revision, 'refs/tags/%s' % revision]
+
+    cmd = r"git -c protocol.version=2 ls-remote {repo} {refs}".format(
+      repo=repo,
+      refs=' '.join("'%s'" % ref for ref in candidates)
+    )
+    lines = self._cmd(cmd, cwd='/tmp', tail=None, timeout=self._phase_timeout('resolve_revision'))
+    if self.last_retcode != 0:
+      self._command_failed("Asking %s for %s" % (repo, revision))
+    refs = {}
+    for line in lines.splitlines():
+      try:
+        sha, ref = line.split('\t')
+      except ValueError:
+        continue
+      refs[ref] = sha
+
+    sha = None
+    for ref in candidates:
+      if ref in refs:
+        sha = refs[ref]
+        break
+
+    # Abbreviated shas can only be resolved against the mirror
+    if sha is None and SHORT_SHA_RE.match(revision) and os.path.isdir(self.mirror_path):
+      out = self._cmd("git rev-parse --quiet --verify {rev}^{{commit}}".format(rev=revision), cwd=self.mirror_path).strip()
+      if SHA_RE.match(out):
+        sha = out
+
+    if sha is not None:
+      cache[key] = [sha, time.time()]
+      self._write_revision_cache(cache)
+    return sha
+
+  def _read_revision_cache(self):
+    """Read the cache of resolved revisions"""
+    try:
+      with open(self.revision_cache_file) as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      return {}
+
+  def _write_revision_cache(self, cache):
+    """Write the cache of resolved revisions"""
+    now = time.time()
+    cache = dict((k, v) for k, v in cache.items() if now - v[1] < self.revision_ttl)
+    try:
+      tmp = self.revision_cache_file + '.tmp'
+      with open(tmp, 'w') as f:
+        json.dump(cache, f)
+      os.rename(tmp, self.revision_cache_file)
+    except (IOError, OSError), e:
+      log.debug("Could not write the revision cache: %s" % e)
 
   def has_been_pulled(self):
     """
@@ -299,41 +940,375 @@ class Rails(App):
 
   def git_pull(self):
    """
-     Pull the repository
+     Pull the repository into a new release from the shared mirror
    """
 
    release_path = os.path.join(self.release_path, self.sha)
+   self._update_mirror(self.repo, self.mirror_path, self.sha)
 
-   cmd = r"git clone --depth=5 {repo} {release_path}".format(
-           repo=self.repo, 
+   # --shared borrows the objects of the mirror through alternates, so a new
+   # release only costs a local checkout
+   cmd = r"git clone --quiet --shared --no-checkout {mirror} {release_path}".format(
+           mirror=self.mirror_path,
            release_path=release_path
          )
-   log.debug("Cloning the repo %s to directory %s" % (self.repo, release_path))
-   cmd_kwargs = {'cwd': '/tmp', 'runas': self.user}
-   res = self._cmd(cmd, **cmd_kwargs)
+   log.debug("Cloning the mirror %s to directory %s" % (self.mirror_path, release_path))
+   self._cmd(cmd, cwd='/tmp')
+   if self.last_retcode != 0:
+     self._command_failed("Cloning %s" % self.mirror_path)
+
+   # Keep the real repository as origin, the objects still come from the mirror
+   self._cmd("git remote set-url origin {repo}".format(repo=self.repo), cwd=release_path)
+   self._checkout_revision(release_path)
+   if self.last_retcode != 0:
+     self._command_failed("Checking out %s" % self.sha)
+   self._update_submodules(release_path)
 
-   if not res:
-     log.error("Something went majorly wrong: %s" % res)
-     raise Exception("Something went majorly wrong: %s" % res)
-   else:
-     # Successfully pulled the repo, if the revision is given
-     cmd_kwargs['cwd'] = self.revision_path
-     if self.revision != "master":
-       log.debug("Checking out branch %s" % self.revision)
-       cmd_ret = self._cmd("git checkout -b %s" % self.revision, **cmd_kwargs)
-       
-     self._cmd("git submodule update --init --recursive", **cmd_kwargs)
-     
    return release_path
-   
+
   def git_update(self):
-    """Update the repo"""
-    cmd = r"git pull origin {branch}".format(
-      branch=self.revision
-    )
-      
+    """Refresh an already pulled release from the shared mirror"""
+    self._update_mirror(self.repo, self.mirror_path, self.sha)
+
+    log.debug("Refreshing %s from %s" % (self.revision_path, self.mirror_path))
+    self._cmd("git fetch --quiet {mirror}".format(mirror=self.mirror_path), cwd=self.revision_path)
+    if self.last_retcode != 0:
+      self._command_failed("Fetching %s" % self.mirror_path)
+    self._checkout_revision(self.revision_path)
+    if self.last_retcode != 0:
+      self._command_failed("Checking out %s" % self.sha)
+    self._update_submodules(self.revision_path)
+
+  def _checkout_revision(self, path):
+    """Check out the resolved sha in the release at path"""
+    if self.revision != "master" and self.revision != self.sha:
+      log.debug("Checking out branch %s at %s" % (self.revision, self.sha))
+      cmd = "git checkout --quiet --force -B {branch} {sha}".format(branch=self.revision, sha=self.sha)
+    else:
+      cmd = "git checkout --quiet --force {sha}".format(sha=self.sha)
+    return self._cmd(cmd, cwd=path)
+
+  def _update_mirror(self, repo, mirror_path, sha=None, flag_cached=True):
+    """
+      Create or incrementally fetch the bare mirror of repo at mirror_path.
+      If sha is given and already present in the mirror, the fetch is skipped,
+      and the phase flagged cached if flag_cached is set.
+    """
+    if not os.path.isdir(mirror_path):
+      if not os.path.isdir(os.path.dirname(mirror_path)):
+        self.makedir_please(os.path.dirname(mirror_path))
+      log.debug("Creating mirror of %s at %s" % (repo, mirror_path))
+      self._cmd("git clone --quiet --mirror {repo} {mirror}".format(repo=repo, mirror=mirror_path), cwd='/tmp')
+      if self.last_retcode != 0:
+        self._command_failed("Mirroring %s" % repo)
+      # Releases borrow objects from the mirror, so it must never drop any
+      self._cmd("git config gc.auto 0", cwd=mirror_path)
+      return mirror_path
+
+    if sha and self._cmd("git cat-file -t {sha}".format(sha=sha), cwd=mirror_path).strip() == 'commit':
+      log.debug("Mirror %s already has %s, not fetching" % (mirror_path, sha))
+      if flag_cached:
+        self._flag_phase('cached')
+      return mirror_path
+
+    log.debug("Fetching %s into mirror %s" % (repo, mirror_path))
+    self._cmd("git fetch --quiet origin", cwd=mirror_path)
+    if self.last_retcode != 0:
+      self._command_failed("Fetching %s" % repo)
+    return mirror_path
+
+  def _update_submodules(self, path):
+    """Check out the submodules of the release at path from their own mirrors"""
+    if not os.path.isfile(os.path.join(path, '.gitmodules')):
+      return
+
+    self._cmd("git submodule init", cwd=path)
+    if self.last_retcode != 0:
+      self._command_failed("Initializing the submodules of %s" % path)
+    lines = self._cmd(r"git config -f .gitmodules --get-regexp '^submodule\..*\.path$'", cwd=path, tail=None)
+    for line in lines.splitlines():
+      try:
+        key, submodule_path = line.split(None, 1)
+      except ValueError:
+        continue
+      name = key[len('submodule.'):-len('.path')]
+      url = self._cmd("git config --get submodule.{name}.url".format(name=name), cwd=path).strip()
+      sha = self._cmd("git rev-parse HEAD:{path}".format(path=submodule_path), cwd=path).strip()
+      mirror = os.path.join(self.submodule_mirror_path, re.sub(r'[^\w.-]', '_', name) + '.git')
+
+      # Only the fetch of the repository itself decides if the phase was cached
+      self._update_mirror(url, mirror, sha, flag_cached=False)
+      # Point the submodule at the local mirror so the update never hits the
+      # network. git 2.38.1 refuses file transports for submodules by default
+      self._cmd("git config submodule.{name}.url {mirror}".format(name=name, mirror=mirror), cwd=path)
+      self._cmd("git -c protocol.file.allow=always submodule update --quiet -- {path}".format(path=submodule_path), cwd=path)
+      if self.last_retcode != 0:
+        self._command_failed("Updating the submodule %s" % submodule_path)
+
+    self._cmd("git -c protocol.file.allow=always submodule update --quiet --init --recursive", cwd=path)
+    if self.last_retcode != 0:
+      self._command_failed("Updating the submodules of %s" % path)
+
+  def fetch_artifact(self):
+    """Unpack the release and bundle the builder published for the sha"""
+    self.get_current_sha()
+    self.previous_release = self._previous_release_path()
+
+    manifest = self._store_read(self._artifact_key('releases', self.sha + '.json'))
+    if manifest is None:
+      raise DeployError("No artifact of %s at %s in %s" % (self.name, self.sha, self.artifact['store']))
+    manifest = json.loads(manifest)
+
+    if self.has_been_pulled():
+      self._flag_phase('cached')
+    else:
+      log.debug("Unpacking the artifact of %s into %s" % (self.sha, self.revision_path))
+      tmp = os.path.join(self.release_path, '.%s.tmp-%s' % (self.sha, os.getpid()))
+      files = self._unpack_object(manifest['release'], tmp)
+      # The files of the release, for _dedup_release
+      self._write_marker(os.path.join(tmp, '.artifact_files'), '\0'.join(files))
+      os.rename(tmp, self.revision_path)
+
+    bundle = manifest['bundle']
+    if bundle and self._read_marker(self.bundle_fingerprint_file) != bundle['fingerprint']:
+      # Unpacked over the shared bundle like bundle install would add to it,
+      # the live release still uses the gems that are there
+      self._unpack_object(bundle, os.path.join(self.shared_path, 'vendor_bundle'))
+      with open(self.shared_bundle_config, 'w') as f:
+        f.write(bundle['config'])
+      self.salt['file.chown'](self.shared_bundle_config, self.user, self.group)
+      self._write_marker(self.bundle_fingerprint_file, bundle['fingerprint'])
+
+  def publish_artifact(self):
+    """
+      Pack the built release and its bundle into the artifact store, named by
+      their sha256, with a manifest for the sha and a ref for the revision
+    """
+    release = self._publish_object(self._pack_release)
+
+    bundle = None
+    fingerprint = self._read_marker(self.bundle_fingerprint_file)
+    if fingerprint:
+      # The bundle only changes with the Gemfile, pack it once per fingerprint
+      bundle_key = self._artifact_key('bundles', fingerprint + '.json')
+      bundle = self._store_read(bundle_key)
+      if bundle is None:
+        bundle = self._publish_object(lambda tar: tar.add(os.path.join(self.shared_path, 'vendor_bundle'), arcname='.', filter=self._owned))
+        bundle.update({'fingerprint': fingerprint, 'config': self._read_marker(self.shared_bundle_config) or ''})
+        self._store_write(bundle_key, json.dumps(bundle))
+      else:
+        bundle = json.loads(bundle)
+
+    manifest = {
+      'name': self.name,
+      'sha': self.sha,
+      'revision': self.revision,
+      'ruby_version': self.ruby_version,
+      'rails_env': self.rails_env,
+      'created': time.time(),
+      'release': release,
+      'bundle': bundle
+    }
+    self._store_write(self._artifact_key('releases', self.sha + '.json'), json.dumps(manifest))
+    self._store_write(self._artifact_key('refs', urllib.quote(self.revision, '')), self.sha)
+    log.info("Published the artifact of %s at %s" % (self.name, self.sha))
+
+  def _build_assets(self):
+    """Compile the assets of the release, on the builder"""
+    assets_digest = self._prepare_assets()
+    if assets_digest and self._run_rake('assets:precompile'):
+      self._assets_compiled(assets_digest)
+
+  def _resolve_artifact_revision(self, revision):
+    """Resolve a revision to the sha the builder last published for it"""
+    if SHA_RE.match(revision):
+      return revision
+    sha = self._store_read(self._artifact_key('refs', urllib.quote(revision, '')))
+    return sha.strip() if sha else None
+
+  def _pack_release(self, tar):
+    """
+      Add the release to tar, with the compiled assets instead of the link to
+      them and without the links to the shared directory of the builder,
+      which the symlinks phase of every node makes to its own
+    """
+    public_assets = os.path.join(self.revision_path, 'public', 'assets')
+    shared = os.path.normpath(self.shared_path) + os.sep
+    def release_filter(info):
+      # The .git of a release borrows its objects from the local mirror
+      if info.name == './.git' or (info.name == './public/assets' and info.issym()):
+        return None
+      if info.issym() and os.path.normpath(info.linkname).startswith(shared):
+        return None
+      return self._owned(info)
+    tar.add(self.revision_path, arcname='.', filter=release_filter)
+    if os.path.islink(public_assets) and os.path.isdir(public_assets):
+      tar.add(os.path.realpath(public_assets), arcname='./public/assets', filter=self._owned)
+
+  def _owned(self, info):
+    """Unpack every file of an artifact as the deploy user"""
+    info.uname, info.gname = self.user, self.group
+    return info
+
+  def _publish_object(self, add):
+    """Write a tarball with add(tar), store it by sha256 and return its manifest entry"""
+    fd, path = tempfile.mkstemp(prefix='deploy-artifact-', suffix='.tar.gz')
+    os.close(fd)
+    try:
+      tar = tarfile.open(path, 'w:gz')
+      try:
+        add(tar)
+      finally:
+        tar.close()
+      digest = _sha256_file(path)
+      key = self._artifact_key('objects', digest + '.tar.gz')
+      if self._store_read(key, probe=True) is None:
+        self._store_write(key, path=path)
+      return {'object': key, 'sha256': digest, 'size': os.path.getsize(path)}
+    finally:
+      os.remove(path)
+
+  def _unpack_object(self, entry, dest):
+    """
+      Fetch an object of the artifact store, check its sha256 and unpack it
+      in dest. Returns the paths of the regular files in it
+    """
+    fd, path = tempfile.mkstemp(prefix='deploy-artifact-', suffix='.tar.gz')
+    os.close(fd)
+    try:
+      self._store_fetch(entry['object'], path)
+      if _sha256_file(path) != entry['sha256']:
+        raise DeployError("Artifact object %s does not match its sha256" % entry['object'])
+      if not os.path.isdir(dest):
+        self.makedir_please(dest)
+      tar = tarfile.open(path)
+      try:
+        # The sha256 comes from the same store, so it proves nothing
+        self._check_members(tar, entry['object'], dest)
+        tar.extractall(dest)
+        return [os.path.normpath(m.name) for m in tar.getmembers() if m.isreg()]
+      finally:
+        tar.close()
+    finally:
+      os.remove(path)
+
+  def _check_members(self, tar, name, dest):
+    """
+      Refuse an artifact with members that would be written outside dest:
+      absolute names, names with .., members inside links, and links out of
+      dest. Symlinks may also point into the shared directory, as the links
+      of the built release do
+    """
+    dest = os.path.normpath(os.path.abspath(dest))
+    link_roots = [dest, os.path.normpath(os.path.abspath(self.shared_path))]
+    members = tar.getmembers()
+    links = set(os.path.normpath(m.name) for m in members if m.issym() or m.islnk())
+
+    def inside(path, roots):
+      return any(path == root or path.startswith(root + os.sep) for root in roots)
+
+    def through_link(relpath):
+      parts = relpath.split(os.sep)
+      return any(os.sep.join(parts[:i]) in links for i in range(1, len(parts)))
+
+    for member in members:
+      relpath = os.path.normpath(member.name)
+      if os.path.isabs(member.name) or '..' in member.name.split('/'):
+        raise DeployError("Artifact object %s has the unsafe member %s" % (name, member.name))
+      if through_link(relpath):
+        raise DeployError("Artifact object %s writes %s through a link" % (name, member.name))
+      if member.isdev():
+        raise DeployError("Artifact object %s has the device %s" % (name, member.name))
+      if member.islnk():
+        target = os.path.normpath(os.path.join(dest, member.linkname))
+        if not inside(target, [dest]) or through_link(os.path.relpath(target, dest)):
+          raise DeployError("Artifact object %s links %s out of the release" % (name, member.name))
+      elif member.issym():
+        target = os.path.normpath(os.path.join(dest, os.path.dirname(relpath), member.linkname))
+        if not inside(target, link_roots) or (inside(target, [dest]) and through_link(os.path.relpath(target, dest))):
+          raise DeployError("Artifact object %s links %s to %s" % (name, member.name, member.linkname))
+
+  def _artifact_key(self, *parts):
+    """The key of an artifact of this application in the store"""
+    return '/'.join((self.name,) + parts)
+
+  def _store_read(self, key, probe=False):
+    """Contents of key in the artifact store, None if it is not there"""
+    store = self.artifact['store']
+    local = _local_store(store)
+    if local is not None:
+      path = os.path.join(local, key)
+      if not os.path.isfile(path):
+        return None
+      if probe:
+        return ''
+      with open(path) as f:
+        return f.read()
+
+    url = '%s/%s' % (store.rstrip('/'), key)
+    if store.startswith('salt://'):
+      cached = self.salt['cp.cache_file'](url, self.env)
+      if not cached:
+        return None
+      with open(cached) as f:
+        return f.read()
+    try:
+      return urllib2.urlopen(url, timeout=60).read()
+    except urllib2.HTTPError, e:
+      if e.code == 404:
+        return None
+      raise DeployError("Could not read %s: %s" % (url, e))
+    except urllib2.URLError, e:
+      raise DeployError("Could not read %s: %s" % (url, e))
+
+  def _store_fetch(self, key, dest):
+    """Copy key from the artifact store to dest"""
+    store = self.artifact['store']
+    local = _local_store(store)
+    url = '%s/%s' % (store.rstrip('/'), key)
+    if local is not None:
+      shutil.copyfile(os.path.join(local, key), dest)
+    elif store.startswith('salt://'):
+      cached = self.salt['cp.cache_file'](url, self.env)
+      if not cached:
+        raise DeployError("Could not fetch %s" % url)
+      shutil.copyfile(cached, dest)
+    else:
+      try:
+        src = urllib2.urlopen(url, timeout=60)
+        with open(dest, 'wb') as f:
+          shutil.copyfileobj(src, f, 1 << 20)
+      except urllib2.URLError, e:
+        raise DeployError("Could not fetch %s: %s" % (url, e))
+
+  def _store_write(self, key, content=None, path=None):
+    """
+      Write content, or the file at path, to key in the artifact store. Only
+      local (or mounted) stores can be written to
+    """
+    local = _local_store(self.artifact['store'])
+    if local is None:
+      raise DeployError("Artifacts can only be published to a directory, not %s" % self.artifact['store'])
+    dest = os.path.join(local, key)
+    if not os.path.isdir(os.path.dirname(dest)):
+      os.makedirs(os.path.dirname(dest))
+    tmp = '%s.tmp-%s' % (dest, os.getpid())
+    if path is not None:
+      shutil.copyfile(path, tmp)
+    else:
+      with open(tmp, 'w') as f:
+        f.write(content)
+    os.chmod(tmp, 0644)
+    os.rename(tmp, dest)
+
   def _create_database_yml(self):
-    defaults = {
+    config_path = os.path.join(self.shared_path, 'config')
+    database_yml_path = os.path.join(config_path, 'database.yml')
+    ret = self._handle_salt_template(database_yml_path, 'salt://states_templates/database.yml', 644, self._database_yml_defaults())
+
+  def _database_yml_defaults(self):
+    """Template variables of database.yml"""
+    return {
       'db_name': self.database.get('name'),
       'db_user': self.database.get('user'),
       'db_password': self.database.get('password'),
@@ -343,21 +1318,45 @@ class Rails(App):
       'db_reconnect': self.database.get('reconnect', 'false'),
       'rails_env': self.rails_env
     }
-    config_path = os.path.join(self.shared_path, 'config')
-    database_yml_path = os.path.join(config_path, 'database.yml')
-    ret = self._handle_salt_template(database_yml_path, 'salt://states_templates/database.yml', 644, defaults)
    
   def _create_config_templates(self):
+    files = []
+    for config_file_path, master_config_file_path, mode, defaults in self._config_template_specs():
+      log.debug("_create_config_template: %s / %s" % (config_file_path, master_config_file_path))
+      files.append({
+        'path': config_file_path,
+        'source': master_config_file_path,
+        'mode': mode,
+        'user': self.user,
+        'group': self.group,
+        'defaults': defaults
+      })
+    if files:
+      return self.salt['deploy_template.manage_many'](files, env=self.env)
+
+  def _config_template_specs(self):
+    """(path, source, mode, defaults) of the config templates"""
     config_path = os.path.join(self.shared_path, 'config')
+    specs = []
     for c in self.config_templates:
       config                  = c.format(environment=self.grains['environment'])
       master_config_file_path = self.config_templates[c].format(environment=self.grains['environment'])
-      
-      defaults  = {'name': self.name}
-      config_file_path = os.path.join(config_path, config)
-      log.debug("%s type ------------------------> %s" % (c, config))
-      log.debug("_create_config_template: %s / %s" % (config_file_path, master_config_file_path))
-      self._handle_salt_template(config_file_path, master_config_file_path, 744, defaults)
+      specs.append((os.path.join(config_path, config), master_config_file_path, 744, {'name': self.name}))
+    return specs
+
+  def _template_specs(self):
+    """(path, source, mode, defaults) of every template a deploy renders"""
+    config_path = os.path.join(self.shared_path, 'config')
+    specs = [(os.path.join(config_path, 'database.yml'), 'salt://states_templates/database.yml', 644, self._database_yml_defaults())]
+    specs.extend(self._config_template_specs())
+    if self.server:
+      specs.append((os.path.join(config_path, 'unicorn.rb'), 'salt://states_templates/unicorn_rb', 644, self._unicorn_defaults()))
+    if self.deploy_key:
+      deploy_key_file = os.path.join(self.docroot, 'id_deploy')
+      specs.append((deploy_key_file, 'salt://states_templates/id_deploy', 600, {'deploy_key': self.deploy_key}))
+      specs.append((os.path.join(self.docroot, '.git_deploy_wrapper.sh'), 'salt://states_templates/git_deploy_wrapper', 755,
+                    self.salt['deploy_ssh.template_defaults'](deploy_key_file, self.deploy_port)))
+    return specs
   
   def _create_symlinks(self):
    """Create symlinks"""
@@ -403,36 +1402,292 @@ class Rails(App):
     
 
   def _run_bundle_install(self):
-   """Run bundle install"""
+   """Run bundle install, unless the Gemfile fingerprint has not changed"""
    shared_vendored_path = os.path.join(self.shared_path, 'vendor_bundle')
+   release_bundle_config = os.path.join(self.revision_path, '.bundle', 'config')
    common_groups = ['development test']
-   cmd = r"bundle install --path={path} --deployment --without {without}".format(path=shared_vendored_path, without=' '.join(common_groups))
+   fingerprint = self._bundle_fingerprint(common_groups)
+
+   if self._bundle_is_current(fingerprint):
+     log.debug("Gemfile fingerprint %s unchanged, skipping bundle install" % fingerprint)
+     self._flag_phase('skipped')
+     # The release still needs the bundler config pointing at the shared bundle
+     self._copy_file(self.shared_bundle_config, release_bundle_config)
+     return True
+
+   cmd = r"bundle install --path={path} --deployment --without {without} --jobs={jobs}".format(
+     path=shared_vendored_path,
+     without=' '.join(common_groups),
+     jobs=self.grains.get('num_cpus', 1)
+   )
    
-   res = self._cmd(cmd)
-   log.debug("Got... %s", res)
+   self._cmd(cmd)
+   if self.last_retcode != 0:
+     self._command_failed("bundle install")
+
+   if os.path.isfile(release_bundle_config):
+     self._copy_file(release_bundle_config, self.shared_bundle_config)
+     self._write_marker(self.bundle_fingerprint_file, fingerprint)
 
    return True
+
+  def _migrations_manifest(self, release):
+    """Map of migration file name to its sha1 in the release"""
+    manifest = {}
+    migrate_dir = os.path.join(release, 'db', 'migrate')
+    if os.path.isdir(migrate_dir):
+      for f in os.listdir(migrate_dir):
+        path = os.path.join(migrate_dir, f)
+        if os.path.isfile(path):
+          with open(path, 'rb') as fh:
+            manifest[f] = hashlib.sha1(fh.read()).hexdigest()
+    return manifest
+
+  def _has_pending_migrations(self, manifest, check_database=True):
+    """
+      Compare the migrations of the release with the ones recorded for the
+      live release, and optionally with schema_migrations
+    """
+    recorded = None
+    for release in [self.revision_path, self._previous_release_path()]:
+      if release:
+        marker = self._read_marker(os.path.join(release, '.migrations_manifest'))
+        if marker is not None:
+          try:
+            recorded = json.loads(marker)
+          except ValueError:
+            recorded = None
+          break
+
+    if recorded is not None:
+      changed = [f for f in manifest if recorded.get(f) != manifest[f]]
+      if not changed:
+        return False
+      log.debug("New or changed migrations: %s" % ', '.join(sorted(changed)))
+
+    if check_database and self.migration_check == 'database':
+      applied = self._applied_migrations()
+      if applied is not None:
+        versions = set(f.split('_', 1)[0] for f in manifest if f.endswith('.rb'))
+        pending = versions - applied
+        log.debug("Migrations pending in the database: %s" % ', '.join(sorted(pending)))
+        return bool(pending)
+
+    return True
+
+  def _applied_migrations(self):
+    """The versions in schema_migrations, or None if they can't be read"""
+    query = 'SELECT version FROM schema_migrations'
+    adapter = self.database.get('adapter') or ''
+    try:
+      if adapter.startswith('mysql'):
+        res = self.salt['mysql.query'](self.database.get('name'), query,
+          connection_host=self.database.get('host', 'localhost'),
+          connection_user=self.database.get('user'),
+          connection_pass=self.database.get('password'),
+          connection_port=self.database.get('port', 3306))
+        return set(str(row[0]) for row in res['results'])
+      elif adapter.startswith('postgres'):
+        res = self.salt['postgres.psql_query'](query,
+          user=self.database.get('user'),
+          host=self.database.get('host', 'localhost'),
+          port=self.database.get('port', 5432),
+          maintenance_db=self.database.get('name'),
+          password=self.database.get('password'))
+        return set(str(row['version']) for row in res)
+    except Exception, e:
+      log.error("Could not read schema_migrations: %s" % e)
+      return None
+    log.debug("Can't check schema_migrations for adapter %s" % adapter)
+    return None
+
+  def _assets_digest(self):
+    """Digest of the asset inputs of the release"""
+    inputs = [i.format(rails_env=self.rails_env) for i in ASSET_INPUTS]
+    return self._digest_files([os.path.join(self.revision_path, i) for i in inputs], extra=[self.rails_env])
+
+  def _prepare_assets(self):
+    """
+      Get the release ready for assets:precompile. Returns the digest of the
+      asset inputs if they need to be compiled, None if the assets are
+      already compiled or could be reused from the live release
+    """
+    digest_file   = os.path.join(self.revision_path, '.assets_digest')
+    public_assets = os.path.join(self.revision_path, 'public', 'assets')
+    shared_assets = os.path.join(self.shared_path, 'assets')
+    digest = self._assets_digest()
+
+    if self._read_marker(digest_file) == digest:
+      log.debug("Assets of %s are already compiled" % self.revision_path)
+      self._flag_phase('skipped')
+      # Later compiles replaced the manifest in the shared assets
+      self._restore_asset_manifest(self.revision_path)
+      return None
+
+    previous = self._previous_release_path()
+    if previous and self._read_marker(os.path.join(previous, '.assets_digest')) == digest:
+      log.debug("Asset inputs unchanged since %s, reusing its assets" % previous)
+      self._flag_phase('cached')
+      self._reuse_assets(os.path.join(previous, 'public', 'assets'), public_assets)
+      self._restore_asset_manifest(previous)
+      self._write_marker(digest_file, digest)
+      return None
+
+    # Compile into the shared assets directory, where the digested files of
+    # the previous compile are already present and don't get written again
+    self._create_symlink(shared_assets, public_assets)
+    return digest
+
+  def _assets_compiled(self, digest):
+    """
+      Mark the assets of the release compiled and keep a copy of its manifest,
+      which the next compile into the shared assets overwrites
+    """
+    public_assets = os.path.join(self.revision_path, 'public', 'assets')
+    saved = os.path.join(self.revision_path, '.assets_manifest')
+    if os.path.isdir(saved):
+      shutil.rmtree(saved)
+    for manifest in self._asset_manifests(public_assets):
+      self._copy_file(manifest, os.path.join(saved, os.path.basename(manifest)))
+    self._write_marker(os.path.join(self.revision_path, '.assets_digest'), digest)
+
+  def _restore_asset_manifest(self, release):
+    """Put the manifest kept by release back into the shared assets this release links to"""
+    public_assets = os.path.join(self.revision_path, 'public', 'assets')
+    shared_assets = os.path.join(self.shared_path, 'assets')
+    saved = os.path.join(release, '.assets_manifest')
+    if not os.path.isdir(saved) or os.path.realpath(public_assets) != os.path.realpath(shared_assets):
+      return
+    if release != self.revision_path:
+      self._reuse_assets(saved, os.path.join(self.revision_path, '.assets_manifest'))
+    for manifest in self._asset_manifests(shared_assets):
+      os.remove(manifest)
+    for manifest in os.listdir(saved):
+      self._copy_file(os.path.join(saved, manifest), os.path.join(shared_assets, manifest))
+
+  def _asset_manifests(self, assets):
+    """The manifest files in an assets directory"""
+    return sorted(set(m for pattern in ASSET_MANIFESTS for m in glob.glob(os.path.join(assets, pattern))))
+
+  def _reuse_assets(self, src, dest):
+    """Give dest the compiled assets in src, hardlinking them if they are not shared"""
+    if os.path.islink(src):
+      self._create_symlink(os.readlink(src), dest)
+    elif os.path.isdir(src):
+      if os.path.islink(dest):
+        os.remove(dest)
+      elif os.path.isdir(dest):
+        shutil.rmtree(dest)
+      self._link_tree(src, dest)
+      self.salt['file.chown'](dest, self.user, self.group)
+
+  def _link_tree(self, src, dest):
+    """Recreate the tree at src in dest, hardlinking files and copying them across devices"""
+    for root, dirs, files in os.walk(src):
+      target_root = os.path.join(dest, os.path.relpath(root, src))
+      if not os.path.isdir(target_root):
+        os.makedirs(target_root)
+      for f in files:
+        source = os.path.join(root, f)
+        target = os.path.join(target_root, f)
+        try:
+          os.link(source, target)
+        except OSError:
+          shutil.copy2(source, target)
+
+  def _previous_release_path(self):
+    """The release current points to, if it is not the one being deployed"""
+    if not os.path.islink(self.current_path):
+      return None
+    previous = os.path.realpath(self.current_path)
+    if previous == os.path.realpath(self.revision_path) or not os.path.isdir(previous):
+      return None
+    return previous
+
+  def _bundle_fingerprint(self, groups):
+    """sha1 of the Gemfile, Gemfile.lock, the ruby version and the excluded groups"""
+    return self._digest_files(
+      [os.path.join(self.revision_path, f) for f in ['Gemfile', 'Gemfile.lock']],
+      extra=[self.ruby_version] + groups
+    )
+
+  def _bundle_is_current(self, fingerprint):
+    """Check if the shared bundle was installed for fingerprint"""
+    return fingerprint == self._read_marker(self.bundle_fingerprint_file) and \
+      os.path.isdir(os.path.join(self.shared_path, 'vendor_bundle', 'ruby')) and \
+      os.path.isfile(self.shared_bundle_config)
+
+  def _digest_files(self, paths, extra=[]):
+    """sha1 over the contents of the given files and directories and any extra strings"""
+    digest = hashlib.sha1()
+    for value in extra:
+      digest.update(value)
+      digest.update('\0')
+    for path in paths:
+      if os.path.isdir(path):
+        files = []
+        for root, dirs, names in os.walk(path):
+          dirs.sort()
+          files.extend(os.path.join(root, n) for n in sorted(names))
+      else:
+        files = [path]
+      for f in files:
+        if not os.path.isfile(f):
+          continue
+        digest.update(os.path.relpath(f, self.revision_path))
+        digest.update('\0')
+        with open(f, 'rb') as fh:
+          for chunk in iter(lambda: fh.read(65536), ''):
+            digest.update(chunk)
+        digest.update('\0')
+    return digest.hexdigest()
+
+  def _read_marker(self, path):
+    """Read a marker file, returning None if it does not exist"""
+    try:
+      with open(path) as f:
+        return f.read().strip()
+    except IOError:
+      return None
+
+  def _write_marker(self, path, value):
+    """Write a marker file"""
+    with open(path, 'w') as f:
+      f.write(value)
+    self.salt['file.chown'](path, self.user, self.group)
+
+  def _copy_file(self, src, dest):
+    """Copy a file, creating its directory, owned by the deploy user"""
+    if not os.path.isdir(os.path.dirname(dest)):
+      self.makedir_please(os.path.dirname(dest))
+    shutil.copyfile(src, dest)
+    self.salt['file.chown'](dest, self.user, self.group)
      
   def _setup_webserver(self):
-    """Setup the webserver"""
-    ## Install unicorn
-    self.salt['rvm.do'](self.ruby_version, 'gem install unicorn --no-ri --no-rdoc')
+    """Setup the webserver, with unicorn installed by the rvm phase"""
     ## First check for a unicorn.rb in the app, otherwise create one
     # TODO: Allow unix sockets
     config_dir = os.path.join(self.shared_path, 'config')
     unicorn_config = os.path.join(config_dir, 'unicorn.rb')
     
-    tmp_dir = os.path.join(self.revision_path, 'tmp')
-    pid_dir = os.path.join(tmp_dir, 'pids')
-    unicorn_pidfile = os.path.join(pid_dir, 'unicorn.pid')
-    
     log.debug("Creating unicorn config at %s with %s" % (unicorn_config, self.server))
-    defaults = {
+    self._measure_worker_rss()
+    ret = self._handle_salt_template(unicorn_config, 'salt://states_templates/unicorn_rb', 644, self._unicorn_defaults())
+    log.info("ret: %s" % ret)
+    
+    self._create_shared_symlink("config/unicorn.rb", "config/unicorn.%s.rb" % self.rails_env)
+
+  def _unicorn_defaults(self):
+    """Template variables of unicorn.rb"""
+    unicorn_pidfile = self._unicorn_pidfile(self.revision_path)
+    sizing = self._unicorn_sizing()
+    return {
       'docroot': self.revision_path,
-      'worker_processes': self.salt['grains.item']('num_cpus'),
+      'worker_processes': sizing['worker_processes'],
       'preload_app': 'true',
       'listen_ports': self.server['ports'],
-      'backlog': self.server.get('backlog', '2048'),
+      'backlog': sizing['backlog'],
+      'timeout': sizing['timeout'],
       'pidfile': unicorn_pidfile,
       'logger': self.server.get('logger', None),
       'before_fork': self.server.get('before_fork', None),
@@ -440,35 +1695,234 @@ class Rails(App):
       'stderr_path': self.server.get('stderr_path', None),
       'stdout_path': self.server.get('stdout_path', None)
     }
-    ret = self._handle_salt_template(unicorn_config, 'salt://states_templates/unicorn_rb', 644, defaults)
-    log.info("ret: %s" % ret)
-    
-    self._create_shared_symlink("config/unicorn.rb", "config/unicorn.%s.rb" % self.rails_env)
+
+  def _unicorn_sizing(self):
+    """
+      Size unicorn to the host: as many workers as there are cpus, times
+      workers_per_cpu, as long as the workers fit in the memory the host has
+      besides the headroom for the system and the services it also runs.
+      Sets self.unicorn_sizing to the outputs and the inputs they came from
+    """
+    server = self.server
+    cpus = int(self.grains.get('num_cpus') or 1)
+    mem_total = int(self.grains.get('mem_total') or _mem_total())
+    headroom, headroom_source = self._memory_headroom()
+
+    recorded = self._read_unicorn_sizing()
+    if server.get('worker_rss'):
+      worker_rss, rss_source = _parse_size(server['worker_rss']), 'configured'
+    elif recorded.get('worker_rss'):
+      worker_rss, rss_source = recorded['worker_rss'], 'measured'
+    else:
+      worker_rss, rss_source = DEFAULT_WORKER_RSS, 'default'
+
+    by_cpu = int(cpus * float(server.get('workers_per_cpu', 1)))
+    by_memory = (mem_total - headroom) // worker_rss
+    if server.get('worker_processes'):
+      workers = int(server['worker_processes'])
+    else:
+      workers = max(min(by_cpu, by_memory), 1)
+
+    # The kernel silently caps the backlog at somaxconn
+    somaxconn = _read_int('/proc/sys/net/core/somaxconn')
+    backlog = int(server.get('backlog') or workers * BACKLOG_PER_WORKER)
+    if somaxconn:
+      backlog = min(backlog, somaxconn)
+
+    self.unicorn_sizing = {
+      'worker_processes': workers,
+      'backlog': backlog,
+      'timeout': int(server.get('timeout', 60)),
+      'inputs': {
+        'cpus': cpus,
+        'mem_total': mem_total,
+        'headroom': headroom,
+        'headroom_from': headroom_source,
+        'worker_rss': worker_rss,
+        'worker_rss_from': rss_source,
+        'workers_by_cpu': by_cpu,
+        'workers_by_memory': by_memory,
+        'somaxconn': somaxconn
+      }
+    }
+    return self.unicorn_sizing
+
+  def _memory_headroom(self):
+    """MB left to the rest of the host, and what went into it"""
+    if self.server.get('memory_headroom') is not None:
+      return _parse_size(self.server['memory_headroom']), ['configured']
+
+    headroom, sources = BASE_HEADROOM, ['system']
+    roles = self.grains.get('role') or self.grains.get('roles') or []
+    if isinstance(roles, basestring):
+      roles = [roles]
+    if 'redis' in roles:
+      maxmemory = self.salt['pillar.get']('redis:maxmemory', '')
+      if maxmemory:
+        headroom += _parse_size(maxmemory)
+        sources.append('redis')
+    return headroom, sources
+
+  def _measure_worker_rss(self):
+    """
+      Record the largest RSS of the unicorn workers of the live release, in
+      steps of 32MB so the sizing does not move with every deploy
+    """
+    if self.server.get('worker_rss') or not os.path.islink(self.current_path):
+      return
+    master = _read_pid(self._unicorn_pidfile(os.path.realpath(self.current_path)))
+    if not master:
+      return
+    rss = [_rss(pid) for pid in _child_pids(master)]
+    rss = [r for r in rss if r]
+    if not rss:
+      return
+    worker_rss = -(-max(rss) // 32) * 32
+    log.debug("Unicorn workers of %s use up to %sMB" % (master, worker_rss))
+    self._write_marker(self.unicorn_sizing_file, json.dumps({'worker_rss': worker_rss, 'workers': len(rss), 'time': time.time()}))
+
+  def _read_unicorn_sizing(self):
+    """The worker RSS recorded by the last deploy"""
+    try:
+      return json.loads(self._read_marker(self.unicorn_sizing_file) or '{}')
+    except ValueError:
+      return {}
+
+  def _unicorn_pidfile(self, release):
+    """The unicorn pidfile of a release"""
+    return os.path.join(release, 'tmp', 'pids', 'unicorn.pid')
 
   def _link_to_current_dir(self):
     """Link revision path to the current directory"""
     log.debug("Linking {revision_path} to {current_path}".format(revision_path=self.revision_path, current_path=self.current_path))
-    self._create_symlink(self.revision_path, self.current_path)
+    self._atomic_symlink(self.revision_path, self.current_path)
+
+  def _atomic_symlink(self, src, dest):
+    """Point dest at src by renaming a new symlink over it, so dest never goes missing"""
+    tmp = '%s.tmp-%s' % (dest, os.getpid())
+    if os.path.lexists(tmp):
+      os.remove(tmp)
+    os.symlink(src, tmp)
+    try:
+      os.lchown(tmp, getpwnam(self.user).pw_uid, getgrnam(self.group).gr_gid)
+    except KeyError:
+      log.debug("Could not chown %s to %s:%s" % (tmp, self.user, self.group))
+    # rename can replace a file or a symlink, but not a directory
+    if os.path.isdir(dest) and not os.path.islink(dest):
+      shutil.rmtree(dest)
+    os.rename(tmp, dest)
+
+  def _reload_webserver(self):
+    """
+      Hand the running unicorn over to the new release: USR2 starts a new
+      master from the new config, which is warmed up before the old master
+      gets QUIT. Nothing happens if no unicorn is running
+    """
+    old_release = getattr(self, 'previous_release', None) or self.revision_path
+    old_pid = _read_pid(self._unicorn_pidfile(old_release))
+    if old_pid is None:
+      log.debug("No unicorn master running for %s, not reloading" % old_release)
+      return False
+
+    new_pidfile = self._unicorn_pidfile(self.revision_path)
+    if not os.path.isdir(os.path.dirname(new_pidfile)):
+      self.makedir_please(os.path.dirname(new_pidfile))
+
+    log.debug("Sending USR2 to unicorn master %s" % old_pid)
+    os.kill(old_pid, signal.SIGUSR2)
+    deadline = time.time() + float(self.server.get('reload_timeout', 60))
+    new_pid = None
+    while time.time() < deadline:
+      new_pid = _read_pid(new_pidfile)
+      if new_pid is not None and new_pid != old_pid:
+        break
+      time.sleep(0.5)
+    else:
+      raise DeployError("The new unicorn master did not come up within %ss, master %s is still serving" % (self.server.get('reload_timeout', 60), old_pid))
+
+    self._warmup_webserver()
+    log.debug("Retiring unicorn master %s for %s" % (old_pid, new_pid))
+    os.kill(old_pid, signal.SIGQUIT)
+    return True
+
+  def _warmup_webserver(self):
+    """Request server['warmup_path'] on every port a few times"""
+    path = self.server.get('warmup_path')
+    if not path:
+      return
+    for port in self.server.get('ports', []):
+      address = str(port) if ':' in str(port) else '127.0.0.1:%s' % port
+      url = 'http://%s/%s' % (address, path.lstrip('/'))
+      for i in range(int(self.server.get('warmup_requests', 5))):
+        try:
+          urllib2.urlopen(url, timeout=float(self.server.get('warmup_timeout', 30))).read()
+        except Exception, e:
+          log.debug("Warmup request to %s failed: %s" % (url, e))
    
-  def _run_rake(self, cmd):
-    """Run rake command"""
-    
-    if self._has_rake_command(cmd):
-      self._cmd("bundle exec rake {cmd}".format(cmd=cmd))
-    
+  def _run_rake(self, *tasks):
+    """
+      Run the rake tasks that are defined, in a single rake invocation.
+      Returns False if none of them is defined, fails the deploy if rake does
+    """
+    defined = self._rake_tasks()
+    tasks = [t for t in tasks if t in defined]
+    if not tasks:
+      return False
+
+    self._cmd("bundle exec rake {tasks}".format(tasks=' '.join(tasks)))
+    if self.last_retcode != 0:
+      self._command_failed("rake %s" % ' '.join(tasks))
+    return True
 
   def _has_rake_command(self, cmd):
     """Check if a rake command is defined"""
-    lines = self._cmd( r"bundle exec rake -T {cmd}".format(cmd=cmd) )
+    return cmd in self._rake_tasks()
+
+  def _rake_tasks(self):
+    """
+      The rake tasks defined by the release. They are listed once per sha
+      and kept in the release, so later checks don't boot the app again
+    """
+    # migrate and after_migrate may ask at the same time, list only once
+    with self._rake_lock:
+      return self._list_rake_tasks()
+
+  def _list_rake_tasks(self):
+    """Rake tasks of the release, from the cache if they were listed before"""
+    if self.sha in self._rake_task_cache:
+      return self._rake_task_cache[self.sha]
+
+    cache_file = os.path.join(self.revision_path, '.rake_tasks')
+    listing = self._read_marker(cache_file)
+    if listing is None:
+      # -P lists every task, including the ones without a description
+      lines = self._cmd("bundle exec rake -P", tail=None)
+      if self.last_retcode != 0:
+        # Without the list db:migrate would be skipped as undefined
+        self._command_failed("Listing the rake tasks")
+      listing = '\n'.join(line.split(None, 1)[1] for line in lines.splitlines()
+                          if line.startswith('rake ') and len(line.split()) > 1)
+      self._write_marker(cache_file, listing)
+
+    self._rake_task_cache[self.sha] = set(listing.split())
+    return self._rake_task_cache[self.sha]
+
+  def _record_timing_history(self, result):
+    """Append the timeline of this deploy to shared/log/deploy_timings.jsonl"""
+    entry = {
+      'time': time.time(),
+      'name': self.name,
+      'revision': self.revision,
+      'sha': getattr(self, 'sha', None),
+      'result': result,
+      'duration': round(_monotonic() - self._started, 3),
+      'timeline': self.timeline
+    }
     try:
-      for line in lines.splitlines():
-        command, desc = line.split('#')
-        search_str = "rake %s" % cmd
-        if search_str in command:
-          return True
-    except Exception:
-      log.error("FAILED checking for rake task: %s" % lines)
-    return False
+      with open(os.path.join(self.shared_path, 'log', 'deploy_timings.jsonl'), 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+    except IOError, e:
+      log.debug("Could not record the deploy timings: %s" % e)
 
   def _error(self, ret, err_msg):
      ret['result'] = False
@@ -502,27 +1956,404 @@ class Rails(App):
      #  require=[]
      #  )
 
-  def _cmd(self, cmd, cwd=None, **cmd_kwargs):
+  def _cmd(self, cmd, cwd=None, tail=OUTPUT_TAIL, timeout=None, **cmd_kwargs):
    """
-     Run a command
+     Run a command in the resolved ruby environment, streaming its output to
+     the deploy log and keeping the last tail lines of it. tail=None keeps
+     everything, for commands whose output is parsed. The command is killed
+     when the running phase runs out of time, or after timeout seconds
    """
    user = cmd_kwargs.get('user', self.user)
-   environ = "HOME=/home/{user} RAILS_ENV={rails_env} GIT_SSH={git_ssh}".format(
-     rails_env=self.rails_env, git_ssh=self.git_deploy_wrapper_file, user=user
-   )
    if not cwd:
      try:
       cwd = self.revision_path
      except:
       cwd = '/tmp'
-      
-   cmd_kwargs = {'cwd': cwd, 'runas': user}
-   set_rvm = "source \"/usr/local/rvm/scripts/rvm\";"
-   cmd = r"{set_rvm} {environ} {cmd}".format(cmd=cmd, set_rvm=set_rvm, environ=environ)
-   return self.salt['cmd.run'](cmd, **cmd_kwargs)
+
+   env = dict(os.environ)
+   env.update(self._ruby_environ(user))
+   env.update({
+     'HOME': _home_dir(user),
+     'RAILS_ENV': self.rails_env,
+     'GIT_SSH': self.git_deploy_wrapper_file
+   })
+   start = _monotonic()
+   deadline = getattr(self._local, 'deadline', None)
+   if deadline is not None:
+     left = deadline - start
+     if left <= 0:
+       raise DeployError("Out of time before running: %s" % cmd)
+     timeout = left if timeout is None else min(timeout, left)
+
+   res = _run_command(cmd, cwd=cwd, user=user, env=env, timeout=timeout, output=self._log_output, tail=tail)
+   self._local.retcode = res['retcode']
+   self._local.result = res
+   self._record_step('command', cmd, start, res['retcode'])
+   if res['timed_out']:
+     raise DeployError("Timed out after %ds: %s\n%s" % (timeout, cmd, res['stderr']))
+   if res['retcode'] != 0:
+     log.debug("Command exited with %s: %s" % (res['retcode'], res['stderr']))
+   return res['stdout']
+
+  def _command_failed(self, what):
+    """Raise a DeployError with the tail of the output of the last command"""
+    res = getattr(self._local, 'result', None) or {}
+    raise DeployError("%s failed with exit code %s:\n%s" % (
+      what, res.get('retcode'), res.get('stderr') or res.get('stdout', '')))
+
+  @property
+  def last_retcode(self):
+    """Exit code of the last command run by _cmd in this thread"""
+    return getattr(self._local, 'retcode', None)
+
+  def _ruby_environ(self, user=None):
+    """
+      The environment rvm sets up for the ruby version and gemset. It is
+      resolved once and shared by every deploy using the same ruby in this
+      process, instead of sourcing rvm for every command
+    """
+    user = user or self.user
+    key = (self.ruby_env_name, user)
+    if key in _RUBY_ENVIRONS:
+      return _RUBY_ENVIRONS[key]
+
+    cmd = 'source "{rvm}" >/dev/null 2>&1 && rvm use {ruby} >/dev/null 2>&1 && env'.format(
+      rvm=RVM_SCRIPT, ruby=self.ruby_env_name
+    )
+    res = _run_command(cmd, cwd='/tmp', user=user, env=dict(os.environ, HOME=_home_dir(user)), timeout=60, tail=None)
+    if res['retcode'] != 0:
+      log.error("Could not resolve the rvm environment for %s: %s" % (self.ruby_env_name, res['stderr']))
+      return {}
+
+    environ = {}
+    for line in res['stdout'].splitlines():
+      name, sep, value = line.partition('=')
+      if sep and (name in RUBY_ENV_VARS or name.startswith('rvm_')):
+        environ[name] = value
+    log.debug("Resolved the rvm environment for %s: %s" % (self.ruby_env_name, environ))
+    _RUBY_ENVIRONS[key] = environ
+    return environ
+
+def _run_phases(phases, concurrency=1):
+  """
+    Run (name, callable, dependencies) phases on up to concurrency threads,
+    each one as soon as its dependencies are done, in the declared order
+    otherwise. After the first failure nothing new is started, and a
+    DeployError naming the failed phase is raised once the running ones
+    are done
+  """
+  names = [name for name, fn, deps in phases]
+  pending = dict((name, (fn, set(deps))) for name, fn, deps in phases)
+  for name, (fn, deps) in pending.items():
+    unknown = deps - set(names)
+    if unknown:
+      raise DeployError("Phase %s depends on unknown phases %s" % (name, ', '.join(sorted(unknown))))
+
+  done = set()
+  running = set()
+  errors = []
+  cond = threading.Condition()
+
+  def run(name, fn):
+    try:
+      log.debug("Starting deploy phase %s" % name)
+      fn()
+      error = None
+    except Exception, e:
+      log.error("Deploy phase %s failed: %s" % (name, traceback.format_exc()))
+      error = (name, e)
+    with cond:
+      running.discard(name)
+      if error:
+        errors.append(error)
+      else:
+        done.add(name)
+      cond.notify()
+
+  with cond:
+    while True:
+      if not errors:
+        for name in names:
+          if len(running) >= max(concurrency, 1):
+            break
+          if name in pending and pending[name][1] <= done:
+            fn, deps = pending.pop(name)
+            running.add(name)
+            t = threading.Thread(target=run, args=(name, fn), name='deploy-%s' % name)
+            t.daemon = True
+            t.start()
+      if not running:
+        break
+      cond.wait()
+
+  if errors:
+    name, e = errors[0]
+    raise DeployError("Deploy phase %s failed: %s" % (name, e))
+  if pending:
+    raise DeployError("Deploy phases %s could never run" % ', '.join(sorted(pending)))
+  return True
+
+def _merge_phases(phases, name, fn, steps):
+  """
+    Replace the phases steps by the single phase name running fn, which
+    waits for everything they waited for and is waited for instead of them
+  """
+  deps = []
+  for phase, phase_fn, phase_deps in phases:
+    if phase in steps:
+      for d in phase_deps:
+        if d not in steps and d not in deps:
+          deps.append(d)
+
+  merged = []
+  for phase, phase_fn, phase_deps in phases:
+    if phase in steps:
+      if not any(m[0] == name for m in merged):
+        merged.append((name, fn, deps))
+      continue
+    phase_deps = [name if d in steps else d for d in phase_deps]
+    merged.append((phase, phase_fn, sorted(set(phase_deps), key=phase_deps.index)))
+  return merged
+
+@contextlib.contextmanager
+def _file_lock(path):
+  """Hold an exclusive flock on path, waiting for it if needed"""
+  if not os.path.isdir(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  with open(path, 'a') as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(f, fcntl.LOCK_UN)
+
+class _TimedLoader(object):
+  """Wraps the salt functions so every call gets recorded"""
+  def __init__(self, funcs, record):
+    self._funcs = funcs
+    self._record = record
+
+  def __getitem__(self, name):
+    fn = self._funcs[name]
+    def timed(*args, **kwargs):
+      start = _monotonic()
+      try:
+        return fn(*args, **kwargs)
+      finally:
+        self._record('salt', name, start)
+    return timed
+
+  def __contains__(self, name):
+    return name in self._funcs
+
+def _monotonic():
+  """Seconds on a clock that never goes backwards"""
+  if _clock_gettime is None:
+    return os.times()[4]
+  ts = _Timespec()
+  _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+  return ts.tv_sec + ts.tv_nsec * 1e-9
+
+class _Timespec(ctypes.Structure):
+  _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+try:
+  _clock_gettime = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True).clock_gettime
+  _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+except (OSError, AttributeError):
+  _clock_gettime = None
+
+def _read_pid(pidfile):
+  """The pid in pidfile, if that process is running"""
+  try:
+    with open(pidfile) as f:
+      pid = int(f.read().strip())
+    os.kill(pid, 0)
+    return pid
+  except (IOError, OSError, ValueError):
+    return None
+
+def _home_dir(user):
+  """The home directory of user"""
+  try:
+    return getpwnam(user).pw_dir
+  except KeyError:
+    return '/home/%s' % user
+
+def _run_command(cmd, cwd='/tmp', user=None, env=None, timeout=None, output=None, tail=OUTPUT_TAIL):
+  """
+    Run cmd through bash as user with exactly the environment env, in a
+    process group of its own. Every line of output is passed to
+    output(stream, line) as it comes and only the last tail lines of each
+    stream are kept. After timeout seconds the process group is terminated,
+    and killed KILL_GRACE seconds later. Returns the same dict as
+    cmd.run_all, with timed_out added
+  """
+  pw = getpwnam(user) if user and os.getuid() == 0 and user != 'root' else None
+  def preexec_fn():
+    os.setsid()
+    # Only plain syscalls between fork and exec: the minion is threaded, and
+    # initgroups would look the groups up with locks another thread may hold.
+    # setgroups still drops the supplementary groups of root
+    if pw:
+      os.setgroups([pw.pw_gid])
+      os.setgid(pw.pw_gid)
+      os.setuid(pw.pw_uid)
+
+  devnull = open(os.devnull)
+  proc = subprocess.Popen(cmd,
+    shell=True,
+    executable='/bin/bash',
+    cwd=cwd,
+    env=env,
+    stdin=devnull,
+    stdout=subprocess.PIPE,
+    stderr=subprocess.PIPE,
+    preexec_fn=preexec_fn,
+    close_fds=True)
+  devnull.close()
+
+  streams = {proc.stdout.fileno(): 'stdout', proc.stderr.fileno(): 'stderr'}
+  lines = dict((name, collections.deque(maxlen=tail)) for name in streams.values())
+  partial = dict((fd, '') for fd in streams)
+  deadline = _monotonic() + timeout if timeout is not None else None
+  timed_out = False
+  kill_at = None
+
+  def emit(fd, line):
+    lines[streams[fd]].append(line)
+    if output:
+      output(streams[fd], line)
+
+  while partial:
+    wait = None
+    now = _monotonic()
+    if deadline is not None and not timed_out:
+      if now >= deadline:
+        log.warning("Timed out after %ss, terminating: %s" % (timeout, cmd))
+        timed_out = True
+        kill_at = now + KILL_GRACE
+        _killpg(proc.pid, signal.SIGTERM)
+      else:
+        wait = deadline - now
+    if kill_at is not None:
+      if now >= kill_at:
+        _killpg(proc.pid, signal.SIGKILL)
+        # Whatever still holds the pipes open is not worth waiting for
+        if now >= kill_at + KILL_GRACE:
+          break
+        wait = KILL_GRACE
+      else:
+        wait = kill_at - now
+
+    try:
+      ready = select.select(list(partial), [], [], wait)[0]
+    except select.error, e:
+      if e.args[0] == errno.EINTR:
+        continue
+      raise
+    for fd in ready:
+      data = os.read(fd, 65536)
+      if not data:
+        if partial[fd]:
+          emit(fd, partial.pop(fd))
+        else:
+          del partial[fd]
+        continue
+      chunk = (partial[fd] + data).split('\n')
+      partial[fd] = chunk.pop()
+      for line in chunk:
+        emit(fd, line)
+
+  proc.stdout.close()
+  proc.stderr.close()
+  retcode = proc.wait()
+  return {
+    'pid': proc.pid,
+    'retcode': retcode,
+    'stdout': '\n'.join(lines['stdout']).rstrip(),
+    'stderr': '\n'.join(lines['stderr']).rstrip(),
+    'timed_out': timed_out
+  }
+
+def _mem_total():
+  """Total memory of the host in MB, from /proc/meminfo"""
+  with open('/proc/meminfo') as f:
+    for line in f:
+      if line.startswith('MemTotal:'):
+        return int(line.split()[1]) // 1024
+  return 0
+
+def _rss(pid):
+  """Resident memory of pid in MB, None if it is gone"""
+  try:
+    with open('/proc/%d/status' % pid) as f:
+      for line in f:
+        if line.startswith('VmRSS:'):
+          return int(line.split()[1]) // 1024
+  except IOError:
+    pass
+  return None
+
+def _child_pids(ppid):
+  """Pids of the children of ppid"""
+  children = []
+  for d in os.listdir('/proc'):
+    if not d.isdigit():
+      continue
+    try:
+      with open('/proc/%s/stat' % d) as f:
+        # The command in parens may hold spaces, the ppid comes after it
+        fields = f.read().rsplit(')', 1)[1].split()
+    except (IOError, IndexError):
+      continue
+    if int(fields[1]) == ppid:
+      children.append(int(d))
+  return children
+
+def _read_int(path):
+  """An integer from a file like the ones in /proc/sys, None if unreadable"""
+  try:
+    with open(path) as f:
+      return int(f.read().strip())
+  except (IOError, ValueError):
+    return None
+
+def _parse_size(value):
+  """A size like 2G, 512mb or 300 (MB) in MB"""
+  match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)b?\s*$', str(value), re.I)
+  if not match:
+    raise DeployError("Invalid size: %s" % value)
+  number, unit = float(match.group(1)), match.group(2).lower()
+  factor = {'k': 1.0 / 1024, '': 1, 'm': 1, 'g': 1024, 't': 1024 * 1024}[unit]
+  return int(number * factor)
+
+def _local_store(store):
+  """The directory of an artifact store that is a path or file:// url, else None"""
+  if store.startswith('file://'):
+    return store[len('file://'):]
+  if store.startswith('/'):
+    return store
+  return None
+
+def _sha256_file(path):
+  """sha256 of the file at path"""
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), ''):
+      digest.update(block)
+  return digest.hexdigest()
+
+def _killpg(pgid, sig):
+  """Signal a process group that may be gone already"""
+  try:
+    os.killpg(pgid, sig)
+  except OSError:
+    pass
     
 def rails(name, repo, docroot, 
           ruby_version='1.9.3-p194',
+          gemset=None,
           database={},
           ssl={},
           server={},
@@ -532,6 +2363,15 @@ def rails(name, repo, docroot,
           deploy_key=None, 
           deploy_port='22',
           revision="master", 
+          revision_ttl=60,
+          migration_check='manifest',
+          rake_tasks=[],
+          concurrency=4,
+          timeouts={},
+          keep_releases=5,
+          dedup_releases=True,
+          artifact={},
+          timing_history=False,
           symlinks={},
           config_templates={},
           env=None,
@@ -555,6 +2395,10 @@ def rails(name, repo, docroot,
     
     ruby_version
       The version of ruby to use
+      
+    gemset
+      The rvm gemset to run the application commands in. Defaults to the
+      default gemset of ruby_version
     
     database
       The database object. This must have the following attributes:
@@ -570,6 +2414,17 @@ def rails(name, repo, docroot,
         options:
           type: unicorn
           port: port
+          reload_timeout: seconds to wait for the new master on a reload
+          warmup_path: path requested on every port before the old master quits
+          warmup_requests: number of warmup requests per port
+          worker_processes: fixed number of workers, otherwise they are sized
+            to the cpus (times workers_per_cpu) and to what fits in memory
+          worker_rss: memory per worker (300M, 1G), otherwise the largest
+            worker of the live release is measured on every deploy
+          memory_headroom: memory left to the rest of the host, otherwise
+            512M plus redis maxmemory on redis nodes
+          backlog: listen backlog, otherwise 64 per worker
+          timeout: seconds before a worker is killed, 60 by default
       
     user
       The user to deploy the application as
@@ -587,7 +2442,64 @@ def rails(name, repo, docroot,
       If the deploy_port is passed, it will use this as a custom port for the repo
     
     revision
-      The revision to check out the application
+      The revision to check out the application. This can be a branch, a tag
+      or a sha
+      
+    revision_ttl
+      The number of seconds a resolved revision is cached before the remote
+      is asked again
+      
+    migration_check
+      How to decide if db:migrate needs to run. With 'manifest' (the default)
+      the migrations of the release are compared with the ones recorded for
+      the live release. With 'database', changed manifests are also checked
+      against schema_migrations using the database settings
+      
+    rake_tasks
+      Extra rake tasks to run after the migrations. They run in the same rake
+      invocation as assets:precompile
+      
+    concurrency
+      The number of deploy phases that may run at the same time. Phases only
+      run once the phases they depend on are done; 1 deploys strictly in order
+      
+    timeouts
+      Seconds the commands of a phase may take altogether, by phase name, with
+      'default' for the phases not named and 'resolve_revision' for asking
+      the remote for the sha. A command still running then is
+      terminated with its process group and fails the deploy. Defaults to
+      PHASE_TIMEOUTS. The output of every command goes to
+      shared/log/deploy-<time>.log, the last keep_releases of which are kept
+      
+    keep_releases
+      The number of releases to keep. Older ones are removed in the background
+      after the launch, except the one current points to
+      
+    dedup_releases
+      Hardlink the files of a new release that are identical to the ones in
+      the previous release
+      
+    artifact
+      Build a release once and distribute it, instead of cloning and building
+      it on every node:
+        mode: build on the one builder, which clones, bundles and compiles
+              the assets, then publishes the release and its bundle. fetch
+              on the other nodes, which unpack them into releases/<sha> and
+              only do the symlinks, migrations and launch
+        store: where the artifacts go, a directory (a shared mount) or file://
+               url the builder writes to. The other nodes can also read from
+               a salt:// or http(s):// url serving that directory
+      The builder and the nodes need the same docroot, ruby and platform,
+      as the bundle holds compiled gems
+
+    timing_history
+      Also append the timeline of every deploy, which is always returned in
+      the changes, to shared/log/deploy_timings.jsonl
+
+  When current already points at the resolved sha and the rendered templates
+  and settings match the ones of the last deploy, nothing is done. With
+  test=True the phases that would run or be skipped are returned in the
+  changes
   """
   ret = {'name': name, 'result': None, 'comment': '', 'changes': {}}
       
@@ -596,6 +2508,7 @@ def rails(name, repo, docroot,
     'repo': repo,
     'docroot': docroot,
     'ruby_version': ruby_version,
+    'gemset': gemset,
     'database': database,
     'ssl': ssl,
     'server': server,
@@ -605,15 +2518,134 @@ def rails(name, repo, docroot,
     'deploy_key': deploy_key,
     'deploy_port': deploy_port,
     'revision': revision,
+    'revision_ttl': revision_ttl,
+    'concurrency': concurrency,
+    'timeouts': timeouts,
+    'keep_releases': keep_releases,
+    'dedup_releases': dedup_releases,
+    'artifact': artifact,
+    'migration_check': migration_check,
+    'rake_tasks': rake_tasks,
     'symlinks': symlinks,
     'config_templates': config_templates,
     'env': env,
     'kwargs': kwargs,
     'salt': __salt__,
-    'grains': __grains__
+    'grains': __grains__,
+    'cachedir': __opts__.get('cachedir', '/var/cache/salt/minion')
   }
   rails = Rails(opts)
-  rails.deploy()
-  ret['result'] = True
-  ret['comment'] = 'Application successfully deployed'
-  return ret
\ No newline at end of file
+  try:
+    try:
+      fingerprint = rails.deploy_fingerprint()
+    except Exception, e:
+      log.debug("Could not fingerprint the deploy, deploying: %s" % e)
+      fingerprint = None
+
+    if fingerprint and rails.is_deployed(fingerprint):
+      ret['result'] = True
+      ret['comment'] = 'Application is already deployed at %s' % rails.sha
+      return ret
+
+    if __opts__.get('test'):
+      ret['comment'] = 'Application would be deployed at %s' % getattr(rails, 'sha', revision)
+      if fingerprint:
+        ret['changes']['phases'] = rails.planned_phases()
+      return ret
+
+    # Only one deploy of a docroot at a time
+    lock_file = os.path.join(opts['cachedir'], 'deploy-%s.lock' % hashlib.sha1(docroot).hexdigest())
+    with _file_lock(lock_file):
+      try:
+        rails.deploy()
+        ret['result'] = True
+        ret['comment'] = 'Application successfully deployed'
+        if fingerprint:
+          rails.record_fingerprint()
+      except DeployError, e:
+        rails._error(ret, str(e))
+    ret['changes']['timeline'] = rails.timeline
+    if rails.unicorn_sizing:
+      ret['changes']['unicorn'] = rails.unicorn_sizing
+    if rails.deploy_log:
+      ret['changes']['log'] = rails.deploy_log
+    if timing_history:
+      rails._record_timing_history(ret['result'])
+  finally:
+    rails.close_connections()
+  return ret
+
+def rails_many(name, apps, concurrency=2, **kwargs):
+  """
+    Deploy several rails applications at once
+    
+    name
+      The name of the state
+      
+    apps
+      A list of applications, each a dict with the arguments of deploy.rails
+      
+    concurrency
+      The number of applications deployed at the same time, each in its own
+      process. Deploys of the same docroot and changes to rvm still wait for
+      each other
+  """
+  ret = {'name': name, 'result': None, 'comment': '', 'changes': {}}
+  names = [app.get('name') for app in apps]
+  if None in names or len(set(names)) != len(names):
+    ret['result'] = False
+    ret['comment'] = 'Every application needs a unique name'
+    return ret
+
+  results = multiprocessing.Queue()
+  pending = list(apps)
+  running = {}
+  while pending or running:
+    while pending and len(running) < max(concurrency, 1):
+      app = pending.pop(0)
+      proc = multiprocessing.Process(target=_rails_worker, args=(app, kwargs, results))
+      proc.start()
+      running[app['name']] = proc
+
+    try:
+      app_name, outcome = results.get(timeout=1)
+      ret['changes'][app_name] = outcome
+      running.pop(app_name).join()
+    except Queue.Empty:
+      # A deploy that died without reporting back
+      for app_name, proc in running.items():
+        if not proc.is_alive() and results.empty():
+          proc.join()
+          del running[app_name]
+          ret['changes'][app_name] = {
+            'result': False,
+            'comment': 'Deploy exited with %s without a result' % proc.exitcode,
+            'duration': None
+          }
+
+  # In test mode a deploy that would run reports None, which is no failure
+  failed = sorted(n for n in names if ret['changes'][n]['result'] is False)
+  if failed:
+    ret['result'] = False
+    ret['comment'] = 'Failed to deploy %s' % ', '.join(failed)
+  elif __opts__['test']:
+    ret['result'] = None
+    ret['comment'] = 'Would deploy %s' % ', '.join(names)
+  else:
+    ret['result'] = True
+    ret['comment'] = 'Successfully deployed %s' % ', '.join(names)
+  return ret
+
+def _rails_worker(app, kwargs, results):
+  """Deploy a single application of rails_many and report back"""
+  args = dict(kwargs)
+  args.update(app)
+  start = time.time()
+  try:
+    res = rails(**args)
+    outcome = {'result': res['result'], 'comment': res['comment']}
+  except Exception, e:
+    log.error("Deploying %s failed: %s" % (app['name'], traceback.format_exc()))
+    outcome = {'result': False, 'comment': str(e)}
+  outcome['duration'] = round(time.time() - start, 3)
+  results.put((app['name'], outcome))
\ No newline at end of file
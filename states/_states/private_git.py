@@ -4,7 +4,9 @@ Support to pull private git repository
 '''
 # Import python libs
 import os
+import Queue
 import logging
+import threading
 
 # Import salt libs
 import salt.utils
@@ -18,14 +20,141 @@ def present(
   deploy_key,
   runas='root',
   deploy_port=22,
-  revision="master"
+  revision="master",
+  depth=5,
+  partial=None,
+  sparse=None,
+  force=False
   ):
-  """Pull a private repository"""
-  ret = {'name': name, 'result': None, 'comment': '', 'changes': {}}
+  """
+  Clone a private repository, or fetch and fast-forward it to revision if
+  target already exists
+
+  depth
+    Clone and fetch only the last depth commits, None for the whole history
+
+  partial
+    A partial clone filter like blob:none or tree:0, so only the objects
+    needed for the checkout are fetched
+
+  sparse
+    A list of paths, only those are checked out
+
+  force
+    Reset to revision if it is not a fast-forward of the checkout
+  """
+  if __opts__.get('test'):
+    # Nothing gets written in test mode, the sync only reads the checkout
+    return _present(name, target, _wrapper_path(target), runas, revision, depth, partial, sparse, force)
+
   _make_target_directory_if_necessary(os.path.dirname(target), user=runas, group=runas, mode=644)
   git_deploy_wrapper_file = _make_deploy_key(target, deploy_key, deploy_port=deploy_port, user=runas, group=runas)
-  _clone_repo(name, target, git_deploy_wrapper_file, user=runas)
+  try:
+    return _present(name, target, git_deploy_wrapper_file, runas, revision, depth, partial, sparse, force)
+  finally:
+    __salt__['deploy_ssh.close'](os.path.join(os.path.dirname(target), 'id_deploy'))
+
+def present_many(name, repos, concurrency=4, **defaults):
+  """
+  Clone or update several private repositories at once
+
+  repos
+    A list of repositories, each a dict with the arguments of present. The
+    arguments they leave out are taken from the ones given to present_many
+
+  concurrency
+    The number of repositories synced at the same time. Repositories in the
+    same directory share a deploy key and so one ssh connection
+  """
+  ret = {'name': name, 'result': True, 'comment': '', 'changes': {}}
+  defaults = dict((k, v) for k, v in defaults.items() if not k.startswith('__'))
+  repos = [dict(defaults, **repo) for repo in repos]
+
+  # The keys and wrappers go first, one per directory, unless in test mode
+  wrappers = {}
+  for repo in repos:
+    key_dir = os.path.dirname(repo['target'])
+    if key_dir not in wrappers:
+      if __opts__.get('test'):
+        wrappers[key_dir] = _wrapper_path(repo['target'])
+        continue
+      runas = repo.get('runas', 'root')
+      _make_target_directory_if_necessary(key_dir, user=runas, group=runas, mode=644)
+      wrappers[key_dir] = _make_deploy_key(repo['target'], repo['deploy_key'],
+        deploy_port=repo.get('deploy_port', 22), user=runas, group=runas)
+
+  pending = Queue.Queue()
+  for repo in repos:
+    pending.put(repo)
+  results = {}
+  def worker():
+    while True:
+      try:
+        repo = pending.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        results[repo['name']] = _present(repo['name'], repo['target'], wrappers[os.path.dirname(repo['target'])],
+          repo.get('runas', 'root'),
+          repo.get('revision', 'master'),
+          repo.get('depth', 5),
+          repo.get('partial'),
+          repo.get('sparse'),
+          repo.get('force', False))
+      except Exception, e:
+        log.error("Syncing {0} failed: {1}".format(repo['name'], e))
+        results[repo['name']] = {'name': repo['name'], 'result': False, 'comment': str(e), 'changes': {}}
+
+  try:
+    threads = [threading.Thread(target=worker) for i in range(max(min(concurrency, len(repos)), 1))]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+  finally:
+    if not __opts__.get('test'):
+      for key_dir in wrappers:
+        __salt__['deploy_ssh.close'](os.path.join(key_dir, 'id_deploy'))
+
+  failed = [n for n, r in results.items() if r['result'] is False]
+  for n, r in results.items():
+    if r['changes']:
+      ret['changes'][n] = r['changes']
+  if failed:
+    ret['result'] = False
+    ret['comment'] = 'Failed to sync {0}'.format(', '.join(sorted(failed)))
+  elif __opts__.get('test'):
+    ret['result'] = None
+    ret['comment'] = '{0} repositories would be synced'.format(len(repos))
+  else:
+    ret['comment'] = '{0} repositories synced'.format(len(repos))
+  return ret
+
+def _present(name, target, git_deploy_wrapper_file, runas, revision, depth, partial, sparse, force):
+  """Sync a single repository, returning its state result"""
+  ret = {'name': name, 'result': None, 'comment': '', 'changes': {}}
+  try:
+    old, new = _sync_repo(name, target, git_deploy_wrapper_file,
+      user=runas,
+      revision=revision,
+      depth=depth,
+      partial=partial,
+      sparse=sparse,
+      force=force)
+  except SaltException, e:
+    ret['result'] = False
+    ret['comment'] = str(e)
+    return ret
+
   ret['result'] = True
+  if __opts__.get('test'):
+    ret['result'] = None
+    ret['comment'] = 'Repository {0} would be synced to {1}'.format(name, revision)
+  elif old != new:
+    ret['changes'] = {'old': old, 'new': new}
+    ret['comment'] = 'Repository {0} is at {1}'.format(name, new)
+  else:
+    ret['comment'] = 'Repository {0} is already at {1}'.format(name, new)
   return ret
   
 
@@ -48,9 +177,8 @@ def _make_target_directory_if_necessary(dir_to_create, user='root', group='root'
 def _make_deploy_key(target, deploy_key, user='deploy', group='deploy', deploy_port=22):
   """docstring for _make_deploy_key"""
   
-  target_dir = os.path.dirname(target)
-  deploy_key_file = os.path.join(target_dir, 'id_deploy')
-  git_deploy_wrapper_file = os.path.join(target_dir, 'git_deploy_wrapper.sh')
+  deploy_key_file = os.path.join(os.path.dirname(target), 'id_deploy')
+  git_deploy_wrapper_file = _wrapper_path(target)
   
   if not __salt__['file.file_exists'](deploy_key_file):      
     _handle_salt_template(deploy_key_file,
@@ -60,79 +188,116 @@ def _make_deploy_key(target, deploy_key, user='deploy', group='deploy', deploy_p
         group=group, 
         defaults={'deploy_key': deploy_key})
   
-  if not __salt__['file.file_exists'](git_deploy_wrapper_file):
-    defaults = {'id_deploy': deploy_key_file, 'port': deploy_port}
-    _handle_salt_template(git_deploy_wrapper_file, 'salt://states_templates/git_deploy_wrapper', 755, defaults=defaults)
+  # Shares one ssh connection per key between the git commands
+  __salt__['deploy_ssh.wrapper'](git_deploy_wrapper_file, deploy_key_file, port=deploy_port, user=user, group=group)
   
   return git_deploy_wrapper_file
     
 
-def _clone_repo(repo, target, git_deploy_wrapper_file, user='root'):
-  """docstring for _clone_repo"""
-  
+def _wrapper_path(target):
+  """The git ssh wrapper shared by the repositories next to target"""
+  return os.path.join(os.path.dirname(target), 'git_deploy_wrapper.sh')
+
+def _sync_repo(repo, target, git_deploy_wrapper_file, user='root', revision='master',
+               depth=5, partial=None, sparse=None, force=False):
+  """Clone or update target, returning the sha it was at and the sha it is at"""
+  exists = __salt__['file.directory_exists'](os.path.join(target, '.git'))
+  old = _git("git rev-parse HEAD", target, git_deploy_wrapper_file, user) if exists else None
+  if __opts__.get('test'):
+    return old, old
+
+  if not exists:
+    _clone_repo(repo, target, git_deploy_wrapper_file, user=user, revision=revision, depth=depth, partial=partial)
+  else:
+    # No depth, so the fetched history reaches back to the checkout and
+    # the fast-forward can be checked
+    _fetch_repo(target, git_deploy_wrapper_file, user=user, revision=revision, depth=None)
+  _set_sparse_paths(target, sparse, git_deploy_wrapper_file, user, apply=exists)
+
+  if exists:
+    _fast_forward(target, git_deploy_wrapper_file, user=user, force=force)
+  else:
+    _git("git checkout --quiet FETCH_HEAD", target, git_deploy_wrapper_file, user)
+  return old, _git("git rev-parse HEAD", target, git_deploy_wrapper_file, user)
+
+def _clone_repo(repo, target, git_deploy_wrapper_file, user='root', revision='master', depth=5, partial=None):
+  """Clone repo without a checkout, and fetch revision into FETCH_HEAD"""
   log.debug("Cloning the repo %s to directory %s" % (repo, target))
-  cmd_kwargs = {'cwd': '/tmp', 'runas': user}
-  user = cmd_kwargs.get('user', user)
+  options = ['--quiet', '--no-checkout']
+  if depth:
+    options.append('--depth={0}'.format(int(depth)))
+  if partial:
+    options.append('--filter={0}'.format(partial))
+  _git("git clone {options} {repo} {target}".format(options=' '.join(options), repo=repo, target=target),
+    '/tmp', git_deploy_wrapper_file, user)
+  _fetch_repo(target, git_deploy_wrapper_file, user=user, revision=revision, depth=depth)
+
+def _fetch_repo(target, git_deploy_wrapper_file, user='root', revision='master', depth=5):
+  """Fetch only revision into FETCH_HEAD, with the objects the checkout misses"""
+  options = ['--quiet']
+  if depth:
+    options.append('--depth={0}'.format(int(depth)))
+  _git("git fetch {options} origin {revision}".format(options=' '.join(options), revision=revision),
+    target, git_deploy_wrapper_file, user)
+
+def _set_sparse_paths(target, sparse, git_deploy_wrapper_file, user='root', apply=True):
+  """
+  Limit the checkout to the sparse paths, or check out everything again.
+  apply updates an existing checkout to the new paths
+  """
+  sparse_file = os.path.join(target, '.git', 'info', 'sparse-checkout')
+  if sparse:
+    content = ''.join('/{0}\n'.format(path.strip('/')) for path in sparse)
+    current = None
+    if os.path.isfile(sparse_file):
+      with open(sparse_file) as f:
+        current = f.read()
+    if current == content:
+      return
+    _git("git config core.sparseCheckout true", target, git_deploy_wrapper_file, user)
+    if not os.path.isdir(os.path.dirname(sparse_file)):
+      os.makedirs(os.path.dirname(sparse_file))
+    with open(sparse_file, 'w') as f:
+      f.write(content)
+  elif os.path.isfile(sparse_file):
+    _git("git config core.sparseCheckout false", target, git_deploy_wrapper_file, user)
+    os.remove(sparse_file)
+  else:
+    return
+
+  if apply:
+    _git("git read-tree -mu HEAD", target, git_deploy_wrapper_file, user)
+
+def _fast_forward(target, git_deploy_wrapper_file, user='root', force=False):
+  """Move the checkout to FETCH_HEAD, if that is a fast-forward or force is set"""
+  head = _git("git rev-parse HEAD", target, git_deploy_wrapper_file, user)
+  fetched = _git("git rev-parse FETCH_HEAD", target, git_deploy_wrapper_file, user)
+  if head == fetched:
+    return
+  is_ancestor = __salt__['cmd.retcode'](
+    "git merge-base --is-ancestor {head} {fetched}".format(head=head, fetched=fetched),
+    cwd=target, runas=user) == 0
+  if not is_ancestor and not force:
+    raise SaltException("{0} is not a fast-forward of {1} in {2}".format(fetched, head, target))
+  _git("git reset --quiet --hard {sha}".format(sha=fetched), target, git_deploy_wrapper_file, user)
+
+def _git(cmd, cwd, git_deploy_wrapper_file, user='root', check=True):
+  """Run a git command with the deploy key, returning its output"""
   environ = "GIT_SSH={git_ssh}".format(git_ssh=git_deploy_wrapper_file)
-  
-  if not __salt__['file.file_exists'](target):
-    cmd = "{environ} git clone --depth=5 {repo} {target}".format(repo=repo, target=target, environ=environ)
-    return __salt__['cmd.run'](cmd, **cmd_kwargs)
+  res = __salt__['cmd.run_all']("{environ} {cmd}".format(environ=environ, cmd=cmd), cwd=cwd, runas=user)
+  if res['retcode'] != 0:
+    if check:
+      raise SaltException("{0} failed: {1}".format(cmd, res['stderr']))
+    return None
+  return res['stdout'].strip()
   
 def _handle_salt_template(path, source, mode, env=None, user='root', group='root', defaults={}, **kwargs):
-  template = 'jinja'
-  backup = ''
-  
+  """Render a template from the master to path"""
   if env is None:
     env = kwargs.get('__env__', 'base')
-  else:
-    env = env
-  
-  log.debug("""
-    --- env ---
-    env: {env}
-  """.format(env=env)
-  )
-  source, source_hash = __salt__['file.source_list'](source,'',env)
-  log.debug(
-    """--- source_list 
-    source: {source}
-    source_hash: {source_hash}
-    """.format(source=source, source_hash=source_hash)
-  )
-  sfn, source_sum, comment = __salt__['file.get_managed'](path,
-    template,
-    source,
-    source_hash,
-    user,
-    group,
-    mode,
-    env,
-    defaults,
-    {})
-  ret = {'name': path, 'result': None, 'comment': '', 'changes': {}}
-  try:
-    log.debug(
-      """---- file.manage_file ----
-        path: {path}
-        sfn: {sfn}
-        ret: {ret}
-        source: {source}
-        source_sum: {source_sum}
-        source_hash: {source_hash}
-        user: {user}
-        group: {group}
-        mode: {mode}
-        env: {env}
-        backup: {backup}
-        comment: {comment}
-      """.format(path=path, sfn=sfn, ret=ret, source=source, source_sum=source_sum, user=user, group=group, mode=mode, env=env, backup=backup, source_hash=source_hash,
-        defaults=defaults,comment=comment)
-    )
-    ret = __salt__['file.manage_file'](path, sfn, ret, source, source_sum, user, group, mode, env, backup)
-    log.debug("""ret for manage_file: {ret}""".format(ret=ret))
-  except Exception, e:
-    log.error("Something went wrong :( {comment} / {exception}".format(comment=ret['comment'], exception=e))
-    raise e
   
-  return ret
\ No newline at end of file
+  return __salt__['deploy_template.manage'](path, source, mode,
+    user=user,
+    group=group,
+    env=env,
+    defaults=defaults)